@@ -16,6 +16,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+import contextlib
+import copy
 import ctypes
 import logging
 import os
@@ -24,7 +27,9 @@ import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import zipfile
+import zlib
 
 from natsort import natsorted
 from unrar import constants
@@ -57,6 +62,9 @@ class OpenableRarFile(rarfile.RarFile):
                 if rarinfo.filename == member:
                     self._process_current(handle, constants.RAR_TEST)
                     found = True
+                    # nothing past this point is needed; in a solid archive
+                    # skipping the rest would even mean decompressing it
+                    break
                 else:
                     self._process_current(handle, constants.RAR_SKIP)
                 rarinfo = self._read_header(handle)
@@ -68,12 +76,41 @@ class OpenableRarFile(rarfile.RarFile):
             raise KeyError('There is no item named %r in the archive' % member)
         return b''.join(buf)
 
+    def extractAll(self, consumer):
+        # decompress every member in one sequential pass, handing
+        # (rarinfo, data) to consumer; stops as soon as it returns False
+        archive = unrarlib.RAROpenArchiveDataEx(self.filename, mode=constants.RAR_OM_EXTRACT)
+        handle = self._open(archive)
+        buf = []
+
+        def _callback(msg, UserData, P1, P2):
+            if msg == constants.UCM_PROCESSDATA:
+                data = (ctypes.c_char * P2).from_address(P1).raw
+                buf.append(data)
+            return 1
+
+        c_callback = unrarlib.UNRARCALLBACK(_callback)
+        unrarlib.RARSetCallback(handle, c_callback, 1)
+        try:
+            rarinfo = self._read_header(handle)
+            while rarinfo is not None:
+                self._process_current(handle, constants.RAR_TEST)
+                data = b''.join(buf)
+                del buf[:]
+                if consumer(rarinfo, data) is False:
+                    break
+                rarinfo = self._read_header(handle)
+        except unrarlib.UnrarException:
+            raise rarfile.BadRarFile("Bad RAR archive data.")
+        finally:
+            self._close(handle)
+
 
 # if platform.system() == "Windows":
 #     import _subprocess
 import time
 
-from io import StringIO
+from io import BytesIO, StringIO
 
 try:
     from PIL import Image
@@ -91,8 +128,11 @@ from comicapi.comicinfoxml import ComicInfoXml
 from comicapi.comicbookinfo import ComicBookInfo
 from comicapi.comet import CoMet
 from comicapi.genericmetadata import GenericMetadata, PageType
+from comicapi.imagesize import getImageSize, readImageSize
 from comicapi.filenameparser import FileNameParser
-from PyPDF2 import PdfFileReader
+from comicapi.pagecache import page_cache
+from comicapi.pdfrender import pdf_render_pool
+from comicapi.rarindex import RarIndex, readRarIndex
 
 
 class MetaDataStyle:
@@ -102,36 +142,220 @@ class MetaDataStyle:
     name = ['ComicBookLover', 'ComicRack', 'CoMet']
 
 
+class ZipFilePool:
+    """
+    Process-wide pool of open, already parsed zipfile.ZipFile objects.
+
+    Opening a ZipFile reads and parses the whole central directory, which
+    for a big comic costs far more than inflating the page we are after.
+    Handles are keyed by path, mtime and size, so a file that changes on
+    disk just misses the pool.  At most max_open handles are kept; when
+    the cap is reached the least recently used idle one is closed.
+
+    A ZipFile opened from a filename can be read from several threads at
+    once, so a handle may be lent to more than one reader.  Handles that
+    are evicted or invalidated while lent out are closed on release.
+    """
+
+    class Entry:
+        def __init__(self, key, zf):
+            self.key = key
+            self.zf = zf
+            self.refcount = 0
+            self.retired = False
+
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    @staticmethod
+    def makeKey(path):
+        statinfo = os.stat(path)
+        return os.path.abspath(path), statinfo.st_mtime_ns, statinfo.st_size
+
+    @contextlib.contextmanager
+    def open(self, path):
+        entry = self.acquire(path)
+        try:
+            yield entry.zf
+        finally:
+            self.release(entry)
+
+    def acquire(self, path):
+        key = self.makeKey(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                entry.refcount += 1
+                return entry
+
+        # parse the directory outside the lock, so other archives
+        # are not held up behind a big one
+        zf = zipfile.ZipFile(path, 'r')
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = ZipFilePool.Entry(key, zf)
+                self.entries[key] = entry
+                self.evict()
+            else:
+                # somebody else got here first
+                self.entries.move_to_end(key)
+                zf.close()
+            entry.refcount += 1
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refcount -= 1
+            if entry.retired and entry.refcount == 0:
+                entry.zf.close()
+
+    def invalidate(self, path):
+        # drop every handle on path, e.g. before the file is rewritten
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == path]:
+                self.retire(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            while len(self.entries) > 0:
+                self.retire(self.entries.popitem(last=False)[1])
+
+    def setMaxOpen(self, max_open):
+        with self.lock:
+            self.max_open = max_open
+            self.evict()
+
+    # the following must be called with self.lock held
+    def evict(self):
+        while len(self.entries) > max(self.max_open, 1):
+            self.retire(self.entries.popitem(last=False)[1])
+
+    def retire(self, entry):
+        entry.retired = True
+        if entry.refcount == 0:
+            entry.zf.close()
+
+
+zip_pool = ZipFilePool()
+
+
+class ArchiveInfoCache:
+    """
+    Small process-wide LRU for things learned about an archive that are
+    costly to find out again, like a RAR listing or member index.  Items
+    are keyed by path, mtime and size, so they go stale with the file.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, path, kind):
+        try:
+            key = ZipFilePool.makeKey(path) + (kind,)
+        except OSError:
+            return None
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, path, kind, value):
+        key = ZipFilePool.makeKey(path) + (kind,)
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+archive_info_cache = ArchiveInfoCache()
+
+
+image_types = {
+    '.jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    'webp': 'image/webp',
+}
+
+
+def imageTypeFromName(name):
+    return image_types.get(name[-4:].lower())
+
+
+class PageEntry:
+    """
+    Where a page lives inside its archive: member name, the byte range of
+    its data in the file and how that data is compressed ('stored',
+    'deflated', or None if only the archiver itself can read it).
+    """
+
+    def __init__(self, name, offset=None, compress_size=None, size=None, crc=None, compression=None):
+        self.name = name
+        self.offset = offset
+        self.compress_size = compress_size
+        self.size = size
+        self.crc = crc
+        self.compression = compression
+        self.image_type = imageTypeFromName(name)
+        self.width = None
+        self.height = None
+
+    def setImageSize(self, image_size):
+        # what the header says beats going by the name
+        if image_size is not None:
+            (self.image_type, self.width, self.height) = image_size
+
+
+def readMemberRange(path, offset, compress_size, size, crc, compression):
+    """Read a member from a known byte range of the file, without opening it as an archive"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(compress_size)
+    if len(data) != compress_size:
+        raise IOError("Short read at {0} of {1}".format(offset, path))
+
+    if compression == 'deflated':
+        try:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise IOError("Bad deflate data at {0} of {1}: {2}".format(offset, path, str(e)))
+    elif compression != 'stored':
+        raise IOError("Can't read {0} data at {1} of {2}".format(compression, offset, path))
+
+    if len(data) != size or (crc is not None and zlib.crc32(data) & 0xffffffff != crc):
+        raise IOError("Data at {0} of {1} doesn't match".format(offset, path))
+    return data
+
+
 class ZipArchiver:
     def __init__(self, path):
         self.path = path
 
     def getArchiveComment(self):
-        zf = zipfile.ZipFile(self.path, 'r')
-        comment = zf.comment
-        zf.close()
-        return comment
+        with zip_pool.open(self.path) as zf:
+            return zf.comment
 
     def setArchiveComment(self, comment):
         return self.writeZipComment(self.path, comment)
 
     def readArchiveFile(self, archive_file):
-        data = ""
-        zf = zipfile.ZipFile(self.path, 'r')
-
         try:
-            data = zf.read(archive_file)
-        except zipfile.BadZipfile as e:
-            logging.error(u"bad zipfile [{0}]: {1} :: {2}".format(e, self.path, archive_file))
-            zf.close()
-            raise IOError
+            with zip_pool.open(self.path) as zf:
+                return zf.read(archive_file)
         except Exception as e:
-            zf.close()
             logging.error(u"bad zipfile [{0}]: {1} :: {2}".format(e, self.path, archive_file))
             raise IOError
-        finally:
-            zf.close()
-        return data
 
     def removeArchiveFile(self, archive_file):
         try:
@@ -150,6 +374,7 @@ class ZipArchiver:
             self.rebuildZipFile([archive_file])
 
             # now just add the archive file as a new one
+            zip_pool.invalidate(self.path)
             zf = zipfile.ZipFile(
                 self.path, mode='a', compression=zipfile.ZIP_DEFLATED)
             zf.writestr(archive_file, data)
@@ -159,12 +384,22 @@ class ZipArchiver:
             logging.exception(e)
             return False
 
+    @staticmethod
+    def memberDataOffset(fp, zinfo):
+        # the local header repeats the name and extra field, and the extra
+        # field needn't be the same as in the central directory
+        fp.seek(zinfo.header_offset)
+        header = fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile("Bad local header for {0}".format(zinfo.filename))
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        # fields 10 and 11 are the name and extra field lengths
+        return zinfo.header_offset + zipfile.sizeFileHeader + fields[10] + fields[11]
+
     def getArchiveFilenameList(self):
         try:
-            zf = zipfile.ZipFile(self.path, 'r')
-            namelist = zf.namelist()
-            zf.close()
-            return namelist
+            with zip_pool.open(self.path) as zf:
+                return zf.namelist()
         except Exception as e:
             logging.error(u"Unable to get zipfile list [{0}]: {1}".format(e, self.path))
             logging.exception(e)
@@ -173,7 +408,9 @@ class ZipArchiver:
     # zip helper func
     def rebuildZipFile(self, exclude_list):
 
-        # this recompresses the zip archive, without the files in the exclude_list
+        # this copies the zip archive, without the files in the exclude_list.
+        # member data is copied as is, still compressed, so a rebuild costs
+        # about a sequential copy of the file
         # errMsg=u"Rebuilding zip {0} without {1}".format( self.path, exclude_list )
 
         # generate temp file
@@ -182,10 +419,42 @@ class ZipArchiver:
 
         zin = zipfile.ZipFile(self.path, 'r')
         zout = zipfile.ZipFile(tmp_name, 'w')
-        for item in zin.infolist():
-            buffer = zin.read(item.filename)
-            if item.filename not in exclude_list:
-                zout.writestr(item, buffer)
+        with open(self.path, 'rb') as fin:
+            for item in zin.infolist():
+                if item.filename in exclude_list:
+                    continue
+
+                data_offset = ZipArchiver.memberDataOffset(fin, item)
+
+                # sizes and CRC are known now, so they go in the local header
+                # and any data descriptor after the data is left behind.
+                # Not for encrypted members though: their password check
+                # byte comes from the mod time rather than the CRC when
+                # there is a data descriptor, so it has to stay
+                zinfo = copy.copy(item)
+                keep_descriptor = bool(item.flag_bits & 0x01) and bool(item.flag_bits & 0x08)
+                if not keep_descriptor:
+                    zinfo.flag_bits &= ~0x08
+                zinfo.extra = ZipArchiver.stripZip64Extra(item.extra)
+                zinfo.header_offset = zout.fp.tell()
+                zip64 = item.file_size > zipfile.ZIP64_LIMIT or item.compress_size > zipfile.ZIP64_LIMIT
+                zout.fp.write(zinfo.FileHeader(zip64))
+
+                fin.seek(data_offset)
+                remaining = item.compress_size
+                while remaining > 0:
+                    chunk = fin.read(min(remaining, 1024 * 1024))
+                    if len(chunk) == 0:
+                        raise zipfile.BadZipfile("Truncated data for {0}".format(item.filename))
+                    zout.fp.write(chunk)
+                    remaining -= len(chunk)
+                if keep_descriptor:
+                    zout.fp.write(struct.pack('<4sLQQ' if zip64 else '<4sLLL', b'PK\x07\x08', item.CRC,
+                                              item.compress_size, item.file_size))
+
+                zout.filelist.append(zinfo)
+                zout.NameToInfo[zinfo.filename] = zinfo
+                zout.start_dir = zout.fp.tell()
 
         # preserve the old comment
         zout.comment = zin.comment
@@ -194,9 +463,22 @@ class ZipArchiver:
         zin.close()
 
         # replace with the new file
+        zip_pool.invalidate(self.path)
         os.remove(self.path)
         os.rename(tmp_name, self.path)
 
+    @staticmethod
+    def stripZip64Extra(extra):
+        # FileHeader() adds its own zip64 field when it is needed
+        out = b''
+        i = 0
+        while i + 4 <= len(extra):
+            tag, size = struct.unpack('<HH', extra[i:i + 4])
+            if tag != 0x0001:
+                out += extra[i:i + 4 + size]
+            i += 4 + size
+        return out
+
     def writeZipComment(self, filename, comment):
         """
         This is a custom function for writing a comment to a zip file,
@@ -207,6 +489,9 @@ class ZipArchiver:
         see: http://en.wikipedia.org/wiki/Zip_(file_format)#Structure
         """
 
+        # the comment is rewritten in place, so drop any pooled handle
+        zip_pool.invalidate(filename)
+
         # get file size
         statinfo = os.stat(filename)
         file_length = statinfo.st_size
@@ -262,21 +547,57 @@ class ZipArchiver:
         else:
             return True
 
-    def copyFromArchive(self, otherArchive):
-        # Replace the current zip with one copied from another archive
+    def copyFromArchive(self, otherArchive, pause=0, cancelled=None):
+        # Replace the current zip with one copied from another archive.
+        # Members are written as they are read, so only one is ever held
+        # in memory.  Images are stored, since they don't deflate anyway,
+        # and pause seconds are slept between members to go easy on the disk.
+        # cancelled, if given, is asked between members whether to give up,
+        # in which case what was copied so far is left incomplete
         try:
+            zip_pool.invalidate(self.path)
             zout = zipfile.ZipFile(self.path, 'w')
-            for fname in otherArchive.getArchiveFilenameList():
-                data = otherArchive.readArchiveFile(fname)
-                if data is not None:
-                    zout.writestr(fname, data)
-            zout.close()
+
+            def addMember(fname, data):
+                if imageTypeFromName(fname) is not None:
+                    zout.writestr(fname, data, compress_type=zipfile.ZIP_STORED)
+                else:
+                    zout.writestr(fname, data, compress_type=zipfile.ZIP_DEFLATED)
+                if pause > 0:
+                    time.sleep(pause)
+
+            def goOn():
+                return cancelled is None or not cancelled()
+
+            if isinstance(otherArchive, RarArchiver):
+                # a single pass through the archive, which in a solid one
+                # is far cheaper than reading the members one by one
+                def consume(rarinfo, data):
+                    if rarinfo.file_size != 0:
+                        addMember(rarinfo.filename, data)
+                    return goOn()
+
+                otherArchive.getRARObj().extractAll(consume)
+            else:
+                for fname in otherArchive.getArchiveFilenameList():
+                    if not goOn():
+                        break
+                    data = otherArchive.readArchiveFile(fname)
+                    if data is not None:
+                        addMember(fname, data)
+
+            if not goOn():
+                zout.close()
+                logging.info(u"Copying to {0} cancelled".format(self.path))
+                return False
 
             # preserve the old comment
             comment = otherArchive.getArchiveComment()
             if comment is not None:
-                if not self.writeZipComment(self.path, comment):
-                    return False
+                if isinstance(comment, str):
+                    comment = comment.encode("UTF-8")
+                zout.comment = comment
+            zout.close()
         except Exception as e:
             logging.error(u"Error while copying to {0}: {1}".format(self.path, e))
             logging.exception(e)
@@ -291,6 +612,11 @@ class ZipArchiver:
 
 class RarArchiver:
     devnull = None
+    decode_solid_once = True
+    # reads that fail are tried this many times in all, waiting retry_delay
+    # before the first retry and twice as long before each one after
+    read_tries = 4
+    retry_delay = 0.05
 
     def __init__(self, path, rar_exe_path):
         self.path = path
@@ -351,6 +677,28 @@ class RarArchiver:
 
     def readArchiveFile(self, archive_file):
 
+        # stored members can be read straight from the file
+        index = self.getIndex()
+        if index is not None:
+            try:
+                data = index.readMember(self.path, archive_file)
+                if data is not None:
+                    return data
+            except (OSError, IOError) as e:
+                logging.error(u"readArchiveFile(): direct read failed [{0}] {1}:{2}".format(
+                    str(e), self.path, archive_file))
+
+            # every read from a solid archive decompresses everything before
+            # the member, so do that once and keep the pages that come out
+            if index.solid and RarArchiver.decode_solid_once:
+                try:
+                    data = self.readSolidMember(archive_file)
+                    if data is not None:
+                        return data
+                except Exception as e:
+                    logging.error(u"readArchiveFile(): solid decode failed [{0}] {1}:{2}".format(
+                        str(e), self.path, archive_file))
+
         # Make sure to escape brackets, since some funky stuff is going on
         # underneath with "fnmatch"
         # archive_file = archive_file.replace("[", '[[]')
@@ -359,7 +707,7 @@ class RarArchiver:
         rarc = self.getRARObj()
 
         tries = 0
-        while tries < 7:
+        while tries < RarArchiver.read_tries:
             try:
                 tries = tries + 1
                 # tmp_folder = tempfile.mkdtemp()
@@ -384,7 +732,7 @@ class RarArchiver:
                 logging.error(
                     u"readArchiveFile(): [{0}]  {1}:{2} attempt#{3}".format(str(e), self.path, archive_file, tries))
                 logging.exception(e)
-                time.sleep(1)
+                time.sleep(RarArchiver.retryDelay(tries))
             except Exception as e:
                 logging.error(u"Unexpected exception in readArchiveFile(): [{0}] for {1}:{2} attempt#{3}".format(
                     str(e), self.path, archive_file, tries))
@@ -403,6 +751,43 @@ class RarArchiver:
 
         raise IOError
 
+    def readSolidMember(self, archive_file):
+
+        data = page_cache.get(self.path, archive_file)
+        if data is not None:
+            return data
+
+        with page_cache.archiveLock(self.path):
+            # another thread may have just made the same pass
+            data = page_cache.get(self.path, archive_file)
+            if data is not None:
+                return data
+
+            # pages ahead of the requested one have most likely been read
+            # already, so only keep it and what follows, while they fit in
+            # half of the cache
+            budget = page_cache.max_bytes // 2
+            found = []
+            kept = 0
+
+            def consume(rarinfo, member_data):
+                nonlocal kept
+                if not found:
+                    if rarinfo.filename != archive_file:
+                        return True
+                    found.append(member_data)
+                elif kept + len(member_data) > budget:
+                    return False
+                page_cache.put(self.path, rarinfo.filename, member_data)
+                kept += len(member_data)
+                return True
+
+            self.getRARObj().extractAll(consume)
+
+        if not found:
+            return None
+        return found[0]
+
     def writeArchiveFile(self, archive_file, data):
 
         if self.rar_exe_path is not None:
@@ -461,12 +846,17 @@ class RarArchiver:
 
     def getArchiveFilenameList(self):
 
+        # an index handed over from the database saves listing the archive
+        index = archive_info_cache.get(self.path, 'rar_index')
+        if index:
+            return [m.name for m in index.members if m.file_size != 0]
+
         rarc = self.getRARObj()
         # namelist = [ item.filename for item in rarc.infolist() ]
         # return namelist
 
         tries = 0
-        while tries < 7:
+        while True:
             try:
                 tries = tries + 1
                 # namelist = [ item.filename for item in rarc.infolist() ]
@@ -478,34 +868,86 @@ class RarArchiver:
             except (OSError, IOError) as e:
                 logging.error(u"getArchiveFilenameList(): [{0}] {1} attempt#{2}".format(
                     str(e), self.path, tries))
-                logging.exception(e)
-                time.sleep(1)
+                if tries >= RarArchiver.read_tries:
+                    raise
+                time.sleep(RarArchiver.retryDelay(tries))
 
             else:
                 # Success"
                 return namelist
 
-        raise e
+    def getIndex(self):
+        """
+        The member index of the archive: data offsets, sizes and solid
+        flags, read once and then kept in memory.  None if the archive
+        can't be indexed.
+        """
+        index = archive_info_cache.get(self.path, 'rar_index')
+        if index is None:
+            try:
+                index = readRarIndex(self.path)
+                if index is not None:
+                    # use the names exactly as unrar reports them, so lookups
+                    # by name agree with the fallback path
+                    infolist = self.getRARObj().infolist()
+                    if len(infolist) == len(index.members):
+                        for member, info in zip(index.members, infolist):
+                            member.name = info.filename
+                        index.by_name = dict((m.name, m) for m in index.members)
+                    else:
+                        # multi-volume or otherwise odd, leave it to unrar
+                        index = None
+            except Exception as e:
+                logging.error(u"getIndex(): [{0}] {1}".format(str(e), self.path))
+                index = None
+            # remember failures too, as False
+            archive_info_cache.put(self.path, 'rar_index', index or False)
+        return index or None
+
+    @staticmethod
+    def seedIndex(path, index_json):
+        """Hand over an index kept elsewhere (i.e. the DB), if still current"""
+        try:
+            index = RarIndex.fromJson(index_json)
+            if index.isCurrentFor(path):
+                archive_info_cache.put(path, 'rar_index', index)
+                return True
+        except Exception as e:
+            logging.error(u"seedIndex(): [{0}] {1}".format(str(e), path))
+        return False
+
+    @staticmethod
+    def loadListing(path):
+        rarc = archive_info_cache.get(path, 'rar_listing')
+        if rarc is None:
+            # rarc = UnRAR2.RarFile( path )
+            rarc = OpenableRarFile(path)
+            archive_info_cache.put(path, 'rar_listing', rarc)
+        return rarc
+
+    @staticmethod
+    def retryDelay(tries):
+        # short and growing, as the wait holds up a thread serving requests
+        return RarArchiver.retry_delay * (2 ** (tries - 1))
 
     def getRARObj(self):
         tries = 0
-        while tries < 7:
+        while True:
             try:
                 tries = tries + 1
-                # rarc = UnRAR2.RarFile( self.path )
-                rarc = OpenableRarFile(self.path)
+                rarc = RarArchiver.loadListing(self.path)
 
             except (OSError, IOError) as e:
                 logging.error(u"getRARObj(): [{0}] {1} attempt#{2}".format(
                     str(e), self.path, tries))
-                logging.exception(e)
-                time.sleep(1)
+                # a file that isn't there won't turn up by waiting for it
+                if tries >= RarArchiver.read_tries or not os.path.exists(self.path):
+                    raise
+                time.sleep(RarArchiver.retryDelay(tries))
             else:
                 # Success"
                 return rarc
 
-        raise e
-
 
 # ------------------------------------------
 # Folder implementation
@@ -608,10 +1050,11 @@ class PdfArchiver:
         return False
 
     def readArchiveFile(self, page_num):
-        return subprocess.check_output([
-            'mudraw', '-o', '-', self.path,
-            str(int(os.path.basename(page_num)[:-4]))
-        ])
+        data = page_cache.get(self.path, page_num)
+        if data is None:
+            data = pdf_render_pool.renderPage(self.path, int(os.path.basename(page_num)[:-4]))
+            page_cache.put(self.path, page_num, data)
+        return data
 
     def writeArchiveFile(self, archive_file, data):
         return False
@@ -620,14 +1063,28 @@ class PdfArchiver:
         return False
 
     def getArchiveFilenameList(self):
-        out = []
-        pdf = PdfFileReader(open(self.path, 'rb'))
-        for page in range(1, pdf.getNumPages() + 1):
-            out.append("/%04d.jpg" % page)
-        return out
+        out = archive_info_cache.get(self.path, 'pdf_pages')
+        if out is None:
+            out = []
+            for page in range(1, pdf_render_pool.countPages(self.path) + 1):
+                out.append("/%04d.png" % page)
+            archive_info_cache.put(self.path, 'pdf_pages', out)
+        return list(out)
 
 
 # ------------------------------------------------------------------
+class ComicArchiveProbe:
+    """What a library scan needs from an archive, as read by ComicArchive.probe()"""
+
+    def __init__(self, archive_type):
+        self.archive_type = archive_type
+        self.page_list = []
+        self.raw_cix = None
+        self.comment = None
+        self.first_page = None
+        self.pages = []
+
+
 class ComicArchive:
     logo_data = None
 
@@ -686,6 +1143,8 @@ class ComicArchive:
         self.cix_md = None
         self.cbi_md = None
         self.comet_md = None
+        self.raw_cix = None
+        self.raw_comment = None
 
     def loadCache(self, style_list):
         for style in style_list:
@@ -699,8 +1158,10 @@ class ComicArchive:
         return zipfile.is_zipfile(self.path)
 
     def rarTest(self):
+        if archive_info_cache.get(self.path, 'rar_index'):
+            return True
         try:
-            rarfile.RarFile(self.path)
+            RarArchiver.loadListing(self.path)
         except Exception as e:
             # logging.exception(e)
             return False
@@ -743,22 +1204,156 @@ class ComicArchive:
 
         return self.isWritable()
 
+    def isComicArchiveType(self):
+        """Whether the name and type alone allow for a comic archive"""
+        # Do we even care about extensions??
+        ext = os.path.splitext(self.path)[1].lower()
+        # or self.isPdf()
+        return (ext == ".cbr" or ext == ".cbz") and (self.isZip() or self.isRar())
+
     def seemsToBeAComicArchive(self):
         try:
-            # Do we even care about extensions??
-            ext = os.path.splitext(self.path)[1].lower()
-            if ext == ".cbr" or ext == ".cbz":
-                # or self.isPdf()
-                if (self.isZip() or self.isRar()) and (self.getNumberOfPages() > 0):
-                    return True
-                else:
-                    return False
-            else:
-                return False
+            return self.isComicArchiveType() and self.getNumberOfPages() > 0
         except Exception as e:
             logging.exception(e)
             return False
 
+    def probe(self):
+        """
+        Read the sorted page list, ComicInfo.xml, archive comment and first
+        page in one go, opening the archive once, and prime the caches used
+        by hasMetadata(), readMetadata() and friends with what was found.
+        The page table that comes with it has each page's dimensions, read
+        from its header where the page can be read on its own.
+        """
+        result = ComicArchiveProbe(self.archive_type)
+
+        # nothing is read from what can't be a comic archive, like a PDF
+        if not self.isComicArchiveType():
+            return result
+
+        if self.isZip():
+            # a scan touches every file once, so leave the pool to the server
+            with zipfile.ZipFile(self.path, 'r') as zf:
+                files = zf.namelist()
+                result.comment = zf.comment
+                result.page_list = self.pageListFromNames(files)
+                found = self.probeMembers(files, result.page_list, zf.read)
+                result.pages = self.zipPageTable(zf, result.page_list)
+
+        else:
+            files = self.archiver.getArchiveFilenameList()
+            rarc = self.archiver.getRARObj()
+            result.comment = rarc.comment
+            result.page_list = self.pageListFromNames(files)
+
+            # stored members straight from the file, the rest in one pass
+            index = self.archiver.getIndex()
+
+            def readMember(name):
+                data = index.readMember(self.path, name) if index is not None else None
+                if data is None:
+                    raise KeyError(name)
+                return data
+
+            found = self.probeMembers(files, result.page_list, readMember)
+            result.pages = self.rarPageTable(index, result.page_list)
+            missing = set(name for name in [self.ci_xml_filename] + result.page_list[:1]
+                          if name in files and name not in found)
+            # compressed pages have to be decompressed whole to get at their
+            # headers, so that is left to the same pass
+            unsized = dict((entry.name, entry) for entry in result.pages if entry.compression is None)
+            if len(missing) > 0 or len(unsized) > 0:
+                def consume(rarinfo, data):
+                    if rarinfo.filename in missing:
+                        found[rarinfo.filename] = data
+                        missing.discard(rarinfo.filename)
+                    if rarinfo.filename in unsized:
+                        unsized.pop(rarinfo.filename).setImageSize(getImageSize(data))
+                    return len(missing) > 0 or len(unsized) > 0
+
+                try:
+                    rarc.extractAll(consume)
+                except Exception as e:
+                    logging.error(u"probe(): [{0}] {1}".format(str(e), self.path))
+
+        if self.ci_xml_filename in files:
+            result.raw_cix = found.get(self.ci_xml_filename, "")
+        if len(result.page_list) > 0:
+            result.first_page = found.get(result.page_list[0])
+            if result.first_page is None:
+                logging.error(u"Error reading in page. Substituting logo page.")
+                result.first_page = ComicArchive.logo_data
+
+        self.page_list = result.page_list
+        self.page_count = len(result.page_list)
+        self.raw_comment = result.comment
+        self.raw_cix = result.raw_cix
+        if self.seemsToBeAComicArchive():
+            self.has_cix = result.raw_cix is not None
+            self.has_cbi = ComicBookInfo().validateString(result.comment)
+        else:
+            self.has_cix = False
+            self.has_cbi = False
+
+        return result
+
+    def zipPageTable(self, zf, page_list):
+        compressions = {zipfile.ZIP_STORED: 'stored', zipfile.ZIP_DEFLATED: 'deflated'}
+        pages = []
+        for name in page_list:
+            zinfo = zf.getinfo(name)
+            entry = PageEntry(name, compress_size=zinfo.compress_size, size=zinfo.file_size, crc=zinfo.CRC)
+            if not zinfo.flag_bits & 0x1:
+                try:
+                    entry.offset = ZipArchiver.memberDataOffset(zf.fp, zinfo)
+                    entry.compression = compressions.get(zinfo.compress_type)
+                    # only inflates as much as the header takes
+                    with zf.open(zinfo) as f:
+                        entry.setImageSize(readImageSize(f, zinfo.file_size))
+                except Exception as e:
+                    logging.error(u"probe(): [{0}] {1}:{2}".format(str(e), self.path, name))
+            pages.append(entry)
+        return pages
+
+    def rarPageTable(self, index, page_list):
+        pages = []
+        for name in page_list:
+            member = index.getMember(name) if index is not None else None
+            if member is None:
+                pages.append(PageEntry(name))
+                continue
+            entry = PageEntry(name, member.offset, member.compress_size, member.file_size, member.crc)
+            if member.isDirectlyReadable():
+                entry.compression = 'stored'
+            pages.append(entry)
+
+        stored = [entry for entry in pages if entry.compression == 'stored']
+        if len(stored) > 0:
+            try:
+                with open(self.path, 'rb') as f:
+                    for entry in stored:
+                        f.seek(entry.offset)
+                        entry.setImageSize(readImageSize(f, entry.size))
+            except (OSError, IOError) as e:
+                logging.error(u"probe(): [{0}] {1}".format(str(e), self.path))
+        return pages
+
+    def probeMembers(self, files, page_list, read):
+        found = dict()
+        wanted = [self.ci_xml_filename]
+        if len(page_list) > 0:
+            wanted.append(page_list[0])
+        for name in wanted:
+            if name in files:
+                try:
+                    found[name] = read(name)
+                except KeyError:
+                    pass
+                except Exception as e:
+                    logging.error(u"probe(): [{0}] {1}:{2}".format(str(e), self.path, name))
+        return found
+
     def readMetadata(self, style):
 
         if style == MetaDataStyle.CIX:
@@ -885,29 +1480,33 @@ class ComicArchive:
 
         if self.page_list is None:
             # get the list file names in the archive, and sort
-            files = self.archiver.getArchiveFilenameList()
-
-            # seems like some archive creators are on  Windows, and don't know about case-sensitivity!
-            if sort_list:
-                def keyfunc(k):
-                    # hack to account for some weird scanner ID pages
-                    # basename=os.path.split(k)[1]
-                    # if basename < '0':
-                    #	k = os.path.join(os.path.split(k)[0], "z" + basename)
-                    return k.lower()
-
-                files = natsorted(files, key=keyfunc)
-
-            # make a sub-list of image files
-            self.page_list = []
-            for name in files:
-                if (name[-4:].lower() in [
-                    ".jpg", "jpeg", ".png", ".gif", "webp"
-                ] and os.path.basename(name)[0] != "."):
-                    self.page_list.append(name)
+            self.page_list = self.pageListFromNames(self.archiver.getArchiveFilenameList(), sort_list)
 
         return self.page_list
 
+    def pageListFromNames(self, files, sort_list=True):
+
+        # seems like some archive creators are on  Windows, and don't know about case-sensitivity!
+        if sort_list:
+            def keyfunc(k):
+                # hack to account for some weird scanner ID pages
+                # basename=os.path.split(k)[1]
+                # if basename < '0':
+                #	k = os.path.join(os.path.split(k)[0], "z" + basename)
+                return k.lower()
+
+            files = natsorted(files, key=keyfunc)
+
+        # make a sub-list of image files
+        page_list = []
+        for name in files:
+            if (name[-4:].lower() in [
+                ".jpg", "jpeg", ".png", ".gif", "webp"
+            ] and os.path.basename(name)[0] != "."):
+                page_list.append(name)
+
+        return page_list
+
     def getNumberOfPages(self):
 
         if self.page_count is None:
@@ -930,7 +1529,12 @@ class ComicArchive:
         if not self.hasCBI():
             return None
 
-        return self.archiver.getArchiveComment()
+        return self.readRawComment()
+
+    def readRawComment(self):
+        if self.raw_comment is None:
+            self.raw_comment = self.archiver.getArchiveComment()
+        return self.raw_comment
 
     def hasCBI(self):
         if self.has_cbi is None:
@@ -939,7 +1543,7 @@ class ComicArchive:
             if not self.seemsToBeAComicArchive():
                 self.has_cbi = False
             else:
-                comment = self.archiver.getArchiveComment()
+                comment = self.readRawComment()
                 self.has_cbi = ComicBookInfo().validateString(comment)
 
         return self.has_cbi
@@ -990,12 +1594,13 @@ class ComicArchive:
     def readRawCIX(self):
         if not self.hasCIX():
             return None
-        try:
-            raw_cix = self.archiver.readArchiveFile(self.ci_xml_filename)
-        except IOError:
-            logging.error(u"Error reading in raw CIX!")
-            raw_cix = ""
-        return raw_cix
+        if self.raw_cix is None:
+            try:
+                self.raw_cix = self.archiver.readArchiveFile(self.ci_xml_filename)
+            except IOError:
+                logging.error(u"Error reading in raw CIX!")
+                self.raw_cix = ""
+        return self.raw_cix
 
     def writeCIX(self, metadata):
 
@@ -1144,8 +1749,12 @@ class ComicArchive:
                         data = self.getPage(idx)
                         if data is not None:
                             try:
-                                im = Image.open(StringIO(data))
-                                w, h = im.size
+                                # the header is enough, no need to decode it all
+                                image_size = getImageSize(data)
+                                if image_size is not None:
+                                    (imtype, w, h) = image_size
+                                else:
+                                    w, h = Image.open(BytesIO(data)).size
 
                                 p['ImageSize'] = str(len(data))
                                 p['ImageHeight'] = str(h)
@@ -1183,10 +1792,10 @@ class ComicArchive:
 
         return metadata
 
-    def exportAsZip(self, zipfilename):
+    def exportAsZip(self, zipfilename, pause=0, cancelled=None):
         if self.archive_type == self.ArchiveType.Zip:
             # nothing to do, we're already a zip
             return True
 
         zip_archiver = ZipArchiver(zipfilename)
-        return zip_archiver.copyFromArchive(self.archiver)
+        return zip_archiver.copyFromArchive(self.archiver, pause, cancelled)
@@ -0,0 +1,121 @@
+"""
+Image type and dimensions from just the first bytes of an image
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import struct
+
+# how much of an image to read, in turn, until its size is found.
+# JPEG headers carrying EXIF thumbnails or ICC profiles can run long
+HEAD_SIZES = [16 * 1024, 256 * 1024]
+
+# JPEG start-of-frame markers, i.e. all of 0xC0-0xCF but DHT, JPG and DAC
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def getImageSize(data):
+    """
+    (MIME type, width, height) of a JPEG, PNG, GIF or WebP image, from as
+    many of its first bytes as are at hand.  None if they aren't enough,
+    or the data isn't one of those.
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(data) >= 24 and data[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', data[16:24])
+            return 'image/png', width, height
+        return None
+
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        if len(data) >= 10:
+            width, height = struct.unpack('<HH', data[6:10])
+            return 'image/gif', width, height
+        return None
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _getWebPSize(data)
+
+    if data[:2] == b'\xff\xd8':
+        return _getJpegSize(data)
+
+    return None
+
+
+def readImageSize(f, size=None):
+    """
+    Like getImageSize(), for the image at the current position of file
+    object f, reading only as much of it as needed.  If given, size is
+    the image's length, so nothing past its end is read.
+    """
+    data = b''
+    for n in HEAD_SIZES + [size]:
+        if n is None:
+            data += f.read()
+        else:
+            if size is not None:
+                n = min(n, size)
+            data += f.read(n - len(data))
+        result = getImageSize(data)
+        if result is not None or (size is not None and len(data) >= size):
+            return result
+    return None
+
+
+def _getWebPSize(data):
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        # lossy: the key frame header has a start code, then 14 bit sizes
+        if len(data) >= 30 and data[23:26] == b'\x9d\x01\x2a':
+            width, height = struct.unpack('<HH', data[26:30])
+            return 'image/webp', width & 0x3fff, height & 0x3fff
+    elif chunk == b'VP8L':
+        # lossless: a signature byte, then sizes less one in 14 bits each
+        if len(data) >= 25 and data[20] == 0x2f:
+            bits = struct.unpack('<I', data[21:25])[0]
+            return 'image/webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif chunk == b'VP8X':
+        # extended: canvas sizes less one in 24 bits each
+        if len(data) >= 30:
+            width = int.from_bytes(data[24:27], 'little') + 1
+            height = int.from_bytes(data[27:30], 'little') + 1
+            return 'image/webp', width, height
+    return None
+
+
+def _getJpegSize(data):
+    # walk the segments up to the first start of frame
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i + 1]
+        if marker == 0xff:
+            # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            # markers without a length
+            i += 2
+            continue
+        if marker in (0xd9, 0xda):
+            # end of image or start of scan, and no frame yet
+            return None
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return 'image/jpeg', width, height
+        i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
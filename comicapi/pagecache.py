@@ -0,0 +1,112 @@
+"""
+A bounded, process-wide cache of raw page images
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import os
+import threading
+import weakref
+
+
+class PageCache:
+    """
+    LRU of page images as they come out of an archive, bounded by their
+    total size in bytes.  Entries are keyed by the archive's path, mtime
+    and size plus the member name, so a changed file never hits.
+
+    Besides the cache proper, there is a lock per archive, so that
+    threads wanting to fill the cache from the same archive (like a
+    full pass over a solid RAR) don't all do the work at once.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.archive_locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def makeKey(path, name):
+        statinfo = os.stat(path)
+        return os.path.abspath(path), statinfo.st_mtime_ns, statinfo.st_size, name
+
+    def get(self, path, name):
+        try:
+            key = self.makeKey(path, name)
+        except OSError:
+            return None
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, path, name, data):
+        if data is None or len(data) > self.max_bytes:
+            return
+        key = self.makeKey(path, name)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self.entries[key] = data
+            self.current_bytes += len(data)
+            self.evict()
+
+    def setMaxBytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def archiveLock(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            lock = self.archive_locks.get(path)
+            if lock is None:
+                lock = threading.Lock()
+                self.archive_locks[path] = lock
+            return lock
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    # must be called with self.lock held
+    def evict(self):
+        while self.current_bytes > self.max_bytes and len(self.entries) > 0:
+            key, data = self.entries.popitem(last=False)
+            self.current_bytes -= len(data)
+
+
+page_cache = PageCache()
@@ -0,0 +1,142 @@
+"""
+A pool of long-lived PDF render processes
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import subprocess
+import threading
+
+from PyPDF2 import PdfFileReader
+
+try:
+    import pymupdf
+
+    mupdf_available = True
+except ImportError:
+    try:
+        import fitz as pymupdf
+
+        mupdf_available = True
+    except ImportError:
+        mupdf_available = False
+
+# same resolution mudraw renders at by default
+RENDER_DPI = 72
+
+# documents each worker keeps open
+MAX_OPEN_DOCUMENTS = 8
+
+# only ever touched inside a worker process
+_documents = collections.OrderedDict()
+
+
+def _openDocument(path, mtime_ns):
+    key = (path, mtime_ns)
+    doc = _documents.pop(key, None)
+    if doc is None:
+        doc = pymupdf.open(path)
+    _documents[key] = doc
+    while len(_documents) > MAX_OPEN_DOCUMENTS:
+        old_key, old_doc = _documents.popitem(last=False)
+        old_doc.close()
+    return doc
+
+
+def _countPages(path, mtime_ns):
+    return _openDocument(path, mtime_ns).page_count
+
+
+def _renderPage(path, mtime_ns, page_number, dpi):
+    page = _openDocument(path, mtime_ns).load_page(page_number - 1)
+    zoom = dpi / 72.0
+    pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom))
+    return pixmap.tobytes("png")
+
+
+class PdfRenderPool:
+    """
+    Renders PDF pages in a few worker processes that stay up and keep the
+    documents they have recently used open, so a page costs a render and
+    not a process start plus a full parse of the file.
+
+    Without PyMuPDF, falls back to running mudraw once per page.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def setWorkers(self, workers):
+        with self.lock:
+            self.workers = workers
+            self.shutdownExecutor(wait=False)
+
+    def getExecutor(self):
+        with self.lock:
+            if self.executor is None:
+                # don't fork a process that is running threads
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def stop(self):
+        with self.lock:
+            self.shutdownExecutor()
+
+    # must be called with self.lock held
+    def shutdownExecutor(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def run(self, func, path, *args):
+        executor = self.getExecutor()
+        try:
+            return executor.submit(func, os.path.abspath(path),
+                                   os.stat(path).st_mtime_ns, *args).result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # a worker died, likely on a bad file; start over with a new pool
+            with self.lock:
+                if self.executor is executor:
+                    self.shutdownExecutor(wait=False)
+            raise IOError(u"PDF render worker died: {0}".format(str(e)))
+        except IOError:
+            raise
+        except Exception as e:
+            raise IOError(u"PDF render failed: {0}".format(str(e)))
+
+    def countPages(self, path):
+        if mupdf_available:
+            return self.run(_countPages, path)
+        with open(path, 'rb') as f:
+            return PdfFileReader(f).getNumPages()
+
+    def renderPage(self, path, page_number):
+        if mupdf_available:
+            return self.run(_renderPage, path, page_number, RENDER_DPI)
+        try:
+            return subprocess.check_output(['mudraw', '-F', 'png', '-o', '-', path, str(page_number)])
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise IOError(u"mudraw failed: {0}".format(str(e)))
+
+
+pdf_render_pool = PdfRenderPool()
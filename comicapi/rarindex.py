@@ -0,0 +1,395 @@
+"""
+Reads the member table of a RAR archive straight from its block headers
+
+The unrar library can only reach a member by walking every header in
+front of it.  Parsing the headers ourselves gives the offset of every
+member's data, so members that are stored without compression can be
+read with a single seek, and the rest at least know up front whether
+the archive is solid.  Both RAR 1.5-4.x and RAR 5.0 archives are
+understood; archives with encrypted headers are not indexed.
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+import struct
+import zlib
+
+RAR4_MARKER = b"Rar!\x1a\x07\x00"
+RAR5_MARKER = b"Rar!\x1a\x07\x01\x00"
+
+# RAR 1.5-4.x block types and flags
+RAR4_MAIN_HEAD = 0x73
+RAR4_FILE_HEAD = 0x74
+RAR4_ENDARC_HEAD = 0x7b
+RAR4_LONG_BLOCK = 0x8000
+RAR4_MHD_SOLID = 0x0008
+RAR4_MHD_PASSWORD = 0x0080
+RAR4_LHD_SPLIT_BEFORE = 0x0001
+RAR4_LHD_SPLIT_AFTER = 0x0002
+RAR4_LHD_PASSWORD = 0x0004
+RAR4_LHD_SOLID = 0x0010
+RAR4_LHD_DIRECTORY = 0x00e0
+RAR4_LHD_LARGE = 0x0100
+RAR4_LHD_UNICODE = 0x0200
+RAR4_METHOD_STORE = 0x30
+RAR4_OS_UNIX = 3
+
+# RAR 5.0 header types and flags
+RAR5_MAIN_HEAD = 1
+RAR5_FILE_HEAD = 2
+RAR5_CRYPT_HEAD = 4
+RAR5_ENDARC_HEAD = 5
+RAR5_HFL_EXTRA = 0x0001
+RAR5_HFL_DATA = 0x0002
+RAR5_HFL_SPLIT_BEFORE = 0x0008
+RAR5_HFL_SPLIT_AFTER = 0x0010
+RAR5_MHD_SOLID = 0x0004
+RAR5_FHD_DIRECTORY = 0x0001
+RAR5_FHD_MTIME = 0x0002
+RAR5_FHD_CRC32 = 0x0004
+RAR5_EXTRA_CRYPT = 0x01
+RAR5_EXTRA_REDIR = 0x05
+
+
+class RarMember:
+    def __init__(self, name, offset, compress_size, file_size, crc=None,
+                 stored=False, solid=False, encrypted=False, isdir=False, split=False):
+        self.name = name
+        self.offset = offset  # file offset of the (packed) member data
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.crc = crc
+        self.stored = stored
+        self.solid = solid
+        self.encrypted = encrypted
+        self.isdir = isdir
+        self.split = split
+
+    def isDirectlyReadable(self):
+        # stored data is the file itself, even inside a solid archive
+        return (self.stored and not self.encrypted and not self.split
+                and not self.isdir and self.compress_size == self.file_size)
+
+
+class RarIndex:
+    # order of the per member fields in the serialized form
+    fields = ['name', 'offset', 'compress_size', 'file_size', 'crc',
+              'stored', 'solid', 'encrypted', 'isdir', 'split']
+
+    def __init__(self, solid=False, members=None, mtime_ns=None, size=None):
+        self.solid = solid
+        self.members = members if members is not None else []
+        # identify the file the index was built from
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.by_name = dict((m.name, m) for m in self.members)
+
+    def getMember(self, name):
+        return self.by_name.get(name)
+
+    def isCurrentFor(self, path):
+        statinfo = os.stat(path)
+        return self.mtime_ns == statinfo.st_mtime_ns and self.size == statinfo.st_size
+
+    def readMember(self, path, name):
+        """Read a stored member with a single seek, or return None"""
+        member = self.getMember(name)
+        if member is None or not member.isDirectlyReadable():
+            return None
+
+        with open(path, 'rb') as f:
+            f.seek(member.offset)
+            data = f.read(member.compress_size)
+
+        if len(data) != member.file_size:
+            raise IOError("Short read of {0} from {1}".format(name, path))
+        if member.crc is not None and zlib.crc32(data) & 0xffffffff != member.crc:
+            raise IOError("CRC mismatch on {0} from {1}".format(name, path))
+        return data
+
+    def toJson(self):
+        return json.dumps({
+            'solid': self.solid,
+            'mtime_ns': self.mtime_ns,
+            'size': self.size,
+            'members': [[getattr(m, f) for f in RarIndex.fields] for m in self.members],
+        })
+
+    @staticmethod
+    def fromJson(text):
+        d = json.loads(text)
+        members = [RarMember(**dict(zip(RarIndex.fields, m))) for m in d['members']]
+        return RarIndex(d['solid'], members, d['mtime_ns'], d['size'])
+
+
+def readRarIndex(path):
+    """
+    Build a RarIndex from the block headers of the archive at path.
+
+    Returns None when the file isn't a RAR archive or its headers can't
+    be read without a password.
+    """
+    statinfo = os.stat(path)
+    with open(path, 'rb') as f:
+        marker = f.read(len(RAR5_MARKER))
+        if marker == RAR5_MARKER:
+            result = _readRar5Headers(f)
+        elif marker[:len(RAR4_MARKER)] == RAR4_MARKER:
+            f.seek(len(RAR4_MARKER))
+            result = _readRar4Headers(f)
+        else:
+            return None
+
+    if result is None:
+        return None
+    solid, members = result
+    return RarIndex(solid, members, statinfo.st_mtime_ns, statinfo.st_size)
+
+
+def _normalizeName(name):
+    # the unrar library hands out names with the native separator
+    return name.replace('\\', '/').replace('/', os.sep)
+
+
+def _readRar4Headers(f):
+    solid = False
+    members = []
+    pos = f.tell()
+    while True:
+        f.seek(pos)
+        block = f.read(7)
+        if len(block) < 7:
+            break
+        crc, head_type, flags, head_size = struct.unpack("<HBHH", block)
+        if head_size < 7:
+            break
+
+        add_size = 0
+        if flags & RAR4_LONG_BLOCK:
+            extra = f.read(4)
+            if len(extra) < 4:
+                break
+            add_size = struct.unpack("<I", extra)[0]
+
+        if head_type == RAR4_MAIN_HEAD:
+            if flags & RAR4_MHD_PASSWORD:
+                return None
+            solid = bool(flags & RAR4_MHD_SOLID)
+
+        elif head_type == RAR4_FILE_HEAD:
+            f.seek(pos)
+            header = f.read(head_size)
+            if len(header) < 32:
+                break
+            (pack_size, unp_size, host_os, file_crc, ftime, unp_ver,
+             method, name_size, attr) = struct.unpack("<IIBIIBBHI", header[7:32])
+            name_pos = 32
+            if flags & RAR4_LHD_LARGE:
+                high_pack, high_unp = struct.unpack("<II", header[32:40])
+                pack_size += high_pack << 32
+                unp_size += high_unp << 32
+                name_pos = 40
+            raw_name = header[name_pos:name_pos + name_size]
+            # the "data" of a symlink is its target, leave those to unrar
+            is_link = host_os == RAR4_OS_UNIX and (attr & 0xf000) == 0xa000
+
+            members.append(RarMember(
+                _normalizeName(_decodeRar4Name(raw_name, flags)),
+                pos + head_size,
+                pack_size,
+                unp_size,
+                crc=file_crc,
+                stored=(method == RAR4_METHOD_STORE and not is_link),
+                solid=bool(flags & RAR4_LHD_SOLID),
+                encrypted=bool(flags & RAR4_LHD_PASSWORD),
+                isdir=(flags & RAR4_LHD_DIRECTORY) == RAR4_LHD_DIRECTORY,
+                split=bool(flags & (RAR4_LHD_SPLIT_BEFORE | RAR4_LHD_SPLIT_AFTER))))
+            # for file headers, the data size is what the long block size holds
+            add_size = pack_size
+
+        elif head_type == RAR4_ENDARC_HEAD:
+            break
+
+        pos += head_size + add_size
+
+    return solid, members
+
+
+def _decodeRar4Name(raw_name, flags):
+    if not flags & RAR4_LHD_UNICODE:
+        # no declared charset; unix rar writes the locale encoding as-is
+        try:
+            return raw_name.decode('utf-8')
+        except UnicodeDecodeError:
+            return raw_name.decode('cp437')
+    if b'\0' not in raw_name:
+        return raw_name.decode('utf-8', 'replace')
+    std_name, enc_name = raw_name.split(b'\0', 1)
+    return _decodeRar4UnicodeName(std_name, enc_name)
+
+
+def _decodeRar4UnicodeName(std_name, enc_name):
+    """
+    RAR 3.x keeps a plain name and a compact "patch" that rebuilds the
+    UTF-16 name from it.  Each 2 bit opcode either emits a byte of the
+    patch (with a zero or a shared high byte), a full UTF-16 unit, or
+    copies a run of characters from the plain name.
+    """
+    out = []
+    enc_pos = 0
+    std_pos = 0
+
+    def enc_byte():
+        nonlocal enc_pos
+        if enc_pos >= len(enc_name):
+            return 0
+        enc_pos += 1
+        return enc_name[enc_pos - 1]
+
+    def std_byte():
+        return std_name[std_pos] if std_pos < len(std_name) else ord('?')
+
+    high = enc_byte()
+    flags = 0
+    flag_bits = 0
+    while enc_pos < len(enc_name):
+        if flag_bits == 0:
+            flags = enc_byte()
+            flag_bits = 8
+        flag_bits -= 2
+        op = (flags >> flag_bits) & 3
+        if op == 0:
+            out.append(bytes([enc_byte(), 0]))
+            std_pos += 1
+        elif op == 1:
+            out.append(bytes([enc_byte(), high]))
+            std_pos += 1
+        elif op == 2:
+            low = enc_byte()
+            out.append(bytes([low, enc_byte()]))
+            std_pos += 1
+        else:
+            length = enc_byte()
+            if length & 0x80:
+                correction = enc_byte()
+                for i in range((length & 0x7f) + 2):
+                    out.append(bytes([(std_byte() + correction) & 0xff, high]))
+                    std_pos += 1
+            else:
+                for i in range(length + 2):
+                    out.append(bytes([std_byte(), 0]))
+                    std_pos += 1
+
+    return b''.join(out).decode('utf-16-le', 'replace')
+
+
+def _readVint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("truncated vint")
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return value, pos
+
+
+def _readRar5Headers(f):
+    solid = False
+    members = []
+    pos = f.tell()
+    try:
+        while True:
+            f.seek(pos)
+            # CRC32 and a vint header size of at most 3 bytes
+            start = f.read(7)
+            if len(start) < 5:
+                break
+            head_size, vint_end = _readVint(start, 4)
+            f.seek(pos + vint_end)
+            header = f.read(head_size)
+            if len(header) < head_size:
+                break
+            data_pos = pos + vint_end + head_size
+
+            head_type, p = _readVint(header, 0)
+            head_flags, p = _readVint(header, p)
+            extra_size = 0
+            data_size = 0
+            if head_flags & RAR5_HFL_EXTRA:
+                extra_size, p = _readVint(header, p)
+            if head_flags & RAR5_HFL_DATA:
+                data_size, p = _readVint(header, p)
+
+            if head_type == RAR5_CRYPT_HEAD:
+                return None
+
+            elif head_type == RAR5_MAIN_HEAD:
+                archive_flags, p = _readVint(header, p)
+                solid = bool(archive_flags & RAR5_MHD_SOLID)
+
+            elif head_type == RAR5_FILE_HEAD:
+                file_flags, p = _readVint(header, p)
+                unp_size, p = _readVint(header, p)
+                attr, p = _readVint(header, p)
+                if file_flags & RAR5_FHD_MTIME:
+                    p += 4
+                file_crc = None
+                if file_flags & RAR5_FHD_CRC32:
+                    file_crc = struct.unpack("<I", header[p:p + 4])[0]
+                    p += 4
+                comp_info, p = _readVint(header, p)
+                host_os, p = _readVint(header, p)
+                name_size, p = _readVint(header, p)
+                name = header[p:p + name_size].decode('utf-8', 'replace')
+
+                encrypted = False
+                is_link = False
+                extra_pos = head_size - extra_size
+                while extra_pos < head_size:
+                    record_size, record_pos = _readVint(header, extra_pos)
+                    record_type, unused = _readVint(header, record_pos)
+                    if record_type == RAR5_EXTRA_CRYPT:
+                        encrypted = True
+                    elif record_type == RAR5_EXTRA_REDIR:
+                        is_link = True
+                    extra_pos = record_pos + record_size
+
+                members.append(RarMember(
+                    _normalizeName(name),
+                    data_pos,
+                    data_size,
+                    unp_size,
+                    crc=file_crc,
+                    stored=((comp_info >> 7) & 7) == 0 and not is_link,
+                    solid=bool(comp_info & 0x40),
+                    encrypted=encrypted,
+                    isdir=bool(file_flags & RAR5_FHD_DIRECTORY),
+                    split=bool(head_flags & (RAR5_HFL_SPLIT_BEFORE | RAR5_HFL_SPLIT_AFTER))))
+
+            elif head_type == RAR5_ENDARC_HEAD:
+                break
+
+            pos = data_pos + data_size
+    except (ValueError, struct.error):
+        # a damaged header ends the walk; keep what was read so far
+        pass
+
+    return solid, members
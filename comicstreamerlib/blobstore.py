@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer content-addressed file store
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+
+class BlobStore:
+    """
+    Files named by the SHA-1 of what's in them, spread over two levels of
+    folders so that none of them gets too big.  The same data is only
+    stored once, and a stored file never changes, so its key can be used
+    as an ETag as is.
+
+    Nothing is kept in memory, so any number of instances, in any number
+    of threads or processes, can share a folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    @staticmethod
+    def makeKey(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def pathFor(self, key):
+        return os.path.join(self.folder, key[:2], key[2:4], key)
+
+    def put(self, data):
+        """Store data, if it isn't already, and return its key"""
+        key = self.makeKey(data)
+        path = self.pathFor(key)
+        if os.path.exists(path):
+            return key
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write aside and rename, so a reader never sees half a file
+        tmp_fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, path)
+        except (OSError, IOError):
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        return key
+
+    def get(self, key):
+        try:
+            with open(self.pathFor(key), 'rb') as f:
+                return f.read()
+        except (OSError, IOError):
+            return None
+
+    def prune(self, keep):
+        """Remove everything whose key isn't in the set keep"""
+        removed = 0
+        if not os.path.exists(self.folder):
+            return removed
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                if name not in keep:
+                    try:
+                        os.remove(os.path.join(root, name))
+                        removed += 1
+                    except OSError as e:
+                        logging.error(u"BlobStore: couldn't remove {0}: {1}".format(name, str(e)))
+        return removed
@@ -30,21 +30,27 @@ from comicstreamerlib.database import Comic
 
 
 class Bookmarker(threading.Thread):
-    def __init__(self, dm):
+    def __init__(self, dm, shared_queue=None):
         super(Bookmarker, self).__init__()
 
-        self.queue = queue.Queue(0)
+        # when serving from several processes, they all hand their
+        # bookmarks to the one running the thread, through a shared queue
+        self.deferred = shared_queue is not None
+        self.queue = shared_queue if self.deferred else queue.Queue(0)
         self.quit = False
         self.dm = dm
 
     def stop(self):
         self.quit = True
-        self.join()
+        if self.is_alive():
+            self.join()
 
     def setBookmark(self, comic_id, pagenum):
-        # for now, don't defer the bookmark setting, maybe it's not needed
-        self.actualSetBookmark(comic_id, pagenum)
-        # self.queue.put((comic_id, pagenum))
+        if self.deferred:
+            self.queue.put((comic_id, pagenum))
+        else:
+            # for now, don't defer the bookmark setting, maybe it's not needed
+            self.actualSetBookmark(comic_id, pagenum)
 
     def run(self):
         logging.debug("Bookmarker: started main loop.")
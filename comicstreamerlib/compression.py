@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer compression of responses, negotiated with Accept-Encoding
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import gzip
+import hashlib
+import threading
+
+import tornado.ioloop
+
+try:
+    import brotli
+
+    brotli_available = True
+except ImportError:
+    brotli_available = False
+
+# bodies smaller than this aren't worth compressing
+MIN_SIZE = 1024
+# bodies larger than this are compressed off the IOLoop
+INLINE_SIZE = 64 * 1024
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml")
+
+
+def isCompressible(content_type):
+    return content_type is not None and content_type.lower().startswith(COMPRESSIBLE_TYPES)
+
+
+def parseAcceptEncoding(header):
+    """The codings of an Accept-Encoding header, with their q values"""
+    codings = {}
+    for item in header.split(","):
+        parts = item.strip().split(";")
+        coding = parts[0].strip().lower()
+        if coding == "":
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def chooseEncoding(header, available):
+    """
+    The first of available the client takes, by its q values and then by
+    the order of available; None if it takes none of them.
+    """
+    if not header:
+        return None
+    codings = parseAcceptEncoding(header)
+    best = None
+    best_q = 0.0
+    for encoding in available:
+        q = codings.get(encoding, codings.get("*", 0.0))
+        if q > best_q:
+            best = encoding
+            best_q = q
+    return best
+
+
+class Compressor:
+    """
+    Compresses response bodies as gzip or brotli, and keeps those the
+    handlers say are worth keeping in an LRU bounded by their total size.
+    Entries are keyed by a hash of the body and the encoding, so nothing
+    changed is ever sent from it.
+    """
+
+    def __init__(self, gzip_level=6, brotli_quality=4, max_bytes=16 * 1024 * 1024):
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def setLevels(self, gzip_level, brotli_quality):
+        with self.lock:
+            self.gzip_level = gzip_level
+            self.brotli_quality = brotli_quality
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def setMaxBytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def getEncodings(self):
+        """Encodings that can be made, the preferred first"""
+        if brotli_available:
+            return ["br", "gzip"]
+        return ["gzip"]
+
+    def encode(self, data, encoding):
+        if encoding == "br":
+            return brotli.compress(data, quality=self.brotli_quality)
+        # no timestamp, so the same body always gives the same bytes
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+    def compress(self, data, encoding, keep=False):
+        """The data compressed; with keep, kept for the next time it is sent"""
+        if not keep or self.max_bytes == 0:
+            return self.encode(data, encoding)
+
+        key = (hashlib.sha1(data).digest(), encoding)
+        with self.lock:
+            compressed = self.entries.get(key)
+            if compressed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return compressed
+
+        compressed = self.encode(data, encoding)
+        if len(compressed) <= self.max_bytes:
+            with self.lock:
+                old = self.entries.pop(key, None)
+                if old is not None:
+                    self.current_bytes -= len(old)
+                self.entries[key] = compressed
+                self.current_bytes += len(compressed)
+                self.evict()
+        return compressed
+
+    async def compressAsync(self, data, encoding, keep=False):
+        """compress(), in the default executor for anything but small bodies"""
+        if len(data) <= INLINE_SIZE:
+            return self.compress(data, encoding, keep)
+        return await tornado.ioloop.IOLoop.current().run_in_executor(None, self.compress, data, encoding, keep)
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'encodings': self.getEncodings(),
+            }
+
+    # must be called with self.lock held
+    def evict(self):
+        while self.current_bytes > self.max_bytes and len(self.entries) > 0:
+            key, data = self.entries.popitem(last=False)
+            self.current_bytes -= len(data)
+
+
+compressor = Compressor()
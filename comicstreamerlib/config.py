@@ -52,6 +52,25 @@ class ComicStreamerConfig(ConfigObj):
             api_key=string(default="")
             use_api_key=boolean(default="False")
             cookie_secret=string(default="")
+            [performance]
+            max_open_archives=integer(min=1, default=32)
+            page_cache_mb=integer(min=1, default=256)
+            solid_rar_decode_once=boolean(default=True)
+            pdf_render_workers=integer(min=1, default=2)
+            transcode_rar=boolean(default=False)
+            transcode_pause=float(min=0, default=0.05)
+            render_cache_mb=integer(min=0, default=512)
+            image_workers=integer(min=0, default=0)
+            max_image_megapixels=integer(min=0, default=200)
+            decode_budget_megapixels=integer(min=0, default=64)
+            large_decodes=integer(min=1, default=2)
+            prefetch_pages=integer(min=0, default=3)
+            db_threads=integer(min=1, default=4)
+            archive_threads=integer(min=1, default=8)
+            processes=integer(min=0, default=1)
+            gzip_level=integer(min=1, max=9, default=6)
+            brotli_quality=integer(min=0, max=11, default=4)
+            compressed_cache_mb=integer(min=0, default=16)
            """
 
     def __init__(self):
@@ -4,9 +4,11 @@
 # Do not change the previous lines. See PEP 8, PEP 263.
 #
 
+import calendar
 import json
 import logging
 import os
+import shutil
 import uuid
 from datetime import date, datetime
 
@@ -22,14 +24,26 @@ from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.properties import ColumnProperty
 
+from comicstreamerlib.blobstore import BlobStore
 from comicstreamerlib.folders import AppFolders
 
-SCHEMA_VERSION = 3
+SCHEMA_VERSION = 8
 
 Base = declarative_base()
 Session = sessionmaker()
 
 
+def makeVersion(mod_ts, filesize):
+    """
+    A token that changes whenever a comic's file does, to put in URLs of
+    what is made from it, so those can be cached for good
+    """
+    if mod_ts is None:
+        return None
+    mtime_ms = calendar.timegm(mod_ts.timetuple()) * 1000 + mod_ts.microsecond // 1000
+    return u"{0:x}-{1:x}".format(mtime_ms, filesize or 0)
+
+
 def resultSetToJson(rset, listname="aaData", total=None):
     return json.dumps(
         resultSetToDict(rset, listname, total),
@@ -74,7 +88,7 @@ def alchemy_encoder():
                     if not x.startswith('_') and x != 'metadata'
                        and not x.endswith('_raw') and x != "persons"
                        and x != "roles" and x != "issue_num" and x != "file"
-                       and x != "folder" and x != "thumbnail"
+                       and x != "folder" and x != "thumbnail" and x != "rar_index"
                 ]:
                     value = obj.__getattribute__(field)
                     if isinstance(value, date):
@@ -184,13 +198,15 @@ class Comic(Base):
     deleted_ts = Column(DateTime)
     lastread_ts = Column(DateTime)
     lastread_page = Column(Integer)
-    thumbnail = deferred(Column(LargeBinary))
+    rar_index = deferred(Column(String))  # member index of RAR archives, as JSON
 
     # hash = Column(String)
     added_ts = Column(DateTime, default=datetime.utcnow)  # when the comic was added to the DB
     mod_ts = Column(DateTime)  # the last modified date of the file
 
     credits_raw = relationship('Credit', cascade="all,delete")
+    pages_raw = relationship('ComicPage', cascade="all,delete", order_by='ComicPage.page')
+    thumbnails_raw = relationship('ComicThumbnail', cascade="all,delete")
     characters_raw = relationship('Character', secondary=comics_characters_table,
                                   cascade="save-update, all, delete", back_populates='comics')
     teams_raw = relationship('Team', secondary=comics_teams_table,
@@ -247,6 +263,34 @@ class Comic(Base):
 
         return out_dict
 
+    @property
+    def version(self):
+        return makeVersion(self.mod_ts, self.filesize)
+
+
+class ComicPage(Base):
+    """One entry of a comic's sorted page list, and where to find it in the file"""
+    __tablename__ = "pages"
+    comic_id = Column(Integer, ForeignKey('comics.id'), primary_key=True)
+    page = Column(Integer, primary_key=True)
+    name = Column(String)  # archive member
+    offset = Column(Integer)  # of the member's data in the file
+    compress_size = Column(Integer)
+    size = Column(Integer)
+    crc = Column(Integer)
+    compression = Column(String)  # 'stored', 'deflated', or NULL if only the archiver can read it
+    image_type = Column(String)  # MIME type
+    width = Column(Integer)
+    height = Column(Integer)
+
+
+class ComicThumbnail(Base):
+    """A rendition of a comic's cover, fitting in a square of a given size"""
+    __tablename__ = "thumbnails"
+    comic_id = Column(Integer, ForeignKey('comics.id'), primary_key=True)
+    size = Column(Integer, primary_key=True)
+    key = Column(String)  # of the JPEG in the DataManager's thumbnail_store
+
 
 class Credit(Base):
     __tablename__ = 'credits'
@@ -410,6 +454,8 @@ class SchemaVersionException(Exception):
 class DataManager:
     def __init__(self):
         self.dbfile = os.path.join(AppFolders.appData(), "comicdb.sqlite")
+        # thumbnails are files of their own, to keep the database small
+        self.thumbnail_store = BlobStore(os.path.join(AppFolders.appData(), "thumbnails"))
 
         self.engine = create_engine('sqlite:///' + self.dbfile, echo=False)
 
@@ -419,6 +465,8 @@ class DataManager:
     def delete(self):
         if os.path.exists(self.dbfile):
             os.unlink(self.dbfile)
+        if os.path.exists(self.thumbnail_store.folder):
+            shutil.rmtree(self.thumbnail_store.folder)
 
     def create(self):
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer Deep Zoom (DZI) tiles of pages
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import logging
+import math
+from io import BytesIO
+
+from PIL import Image
+
+import comicstreamerlib.utils
+from comicapi.pagecache import page_cache
+from comicstreamerlib.imagepool import image_pool, imagePixels
+from comicstreamerlib.workerpool import archive_pool
+
+TILE_SIZE = 254
+TILE_OVERLAP = 1
+TILE_QUALITY = 75
+
+
+def levelCount(width, height):
+    """Levels of an image; the last is full size, each one before half the next"""
+    return int(math.ceil(math.log(max(width, height, 1), 2))) + 1
+
+
+def levelSize(width, height, level):
+    scale = 0.5 ** (levelCount(width, height) - 1 - level)
+    return max(int(math.ceil(width * scale)), 1), max(int(math.ceil(height * scale)), 1)
+
+
+def tileGrid(level_width, level_height):
+    """Columns and rows of tiles in a level of the given size"""
+    return int(math.ceil(level_width / float(TILE_SIZE))), int(math.ceil(level_height / float(TILE_SIZE)))
+
+
+def descriptor(width, height):
+    return (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+            u'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            u'Format="jpg" Overlap="{0}" TileSize="{1}">\n'
+            u'  <Size Width="{2}" Height="{3}"/>\n'
+            u'</Image>\n').format(TILE_OVERLAP, TILE_SIZE, width, height)
+
+
+def decodedSize(image_data):
+    """
+    Size of the page as it gets decoded: a JPEG over the decode budget is
+    only ever decoded at reduced scale, so there is no more to zoom into
+    """
+    return comicstreamerlib.utils.openImage(image_data).size
+
+
+def makeRowTiles(image_data, level_width, level_height, row):
+    """
+    The tiles of one row of a level as JPEGs, by column.  Runs in an image
+    worker; only the band of the page the row covers is scaled and encoded.
+    """
+    img = comicstreamerlib.utils.openImage(image_data, (level_width, level_height))
+    img = img.convert('RGB')
+    # each tile reaches into its neighbours by the overlap
+    top = max(row * TILE_SIZE - TILE_OVERLAP, 0)
+    bottom = min((row + 1) * TILE_SIZE + TILE_OVERLAP, level_height)
+    if img.size == (level_width, level_height):
+        band = img.crop((0, top, level_width, bottom))
+    else:
+        scale = img.size[1] / float(level_height)
+        band = img.resize((level_width, bottom - top), Image.LANCZOS,
+                          box=(0, top * scale, img.size[0], bottom * scale))
+
+    tiles = {}
+    (columns, rows) = tileGrid(level_width, level_height)
+    for col in range(columns):
+        x = col * TILE_SIZE
+        box = (max(x - TILE_OVERLAP, 0), 0, min(x + TILE_SIZE + TILE_OVERLAP, level_width), bottom - top)
+        out = BytesIO()
+        band.crop(box).save(out, "JPEG", quality=TILE_QUALITY)
+        tiles[col] = out.getvalue()
+    return tiles
+
+
+class DeepZoom:
+    """
+    Tiles of pages, made a row at a time on first use and kept in the
+    render cache, or in the page cache when there is no render cache.
+    Requests for tiles of a row that is being made wait for that instead
+    of starting over.
+
+    The full size is that of the page as decoded, so a page over the decode
+    budget is zoomed into no further than its reduced scale.
+    """
+
+    def __init__(self, library):
+        self.library = library
+        self.pending = {}
+
+    def getPageSize(self, comic_id, page_number):
+        size = self.library.getComicPageSize(comic_id, page_number)
+        budget = comicstreamerlib.utils.UtilsVars.decode_budget
+        if size is None or not budget or size[0] * size[1] <= budget:
+            return size
+
+        # found from the page's header once, and then kept
+        path = self.library.getComicPath(comic_id)
+        if path is None:
+            return None
+        name = u"dzi:{0}:size".format(int(page_number))
+        data = page_cache.get(path, name)
+        if data is not None:
+            return tuple(int(n) for n in data.decode('ascii').split("x"))
+        image_data, image_type = self.library.getComicPageData(comic_id, page_number)
+        if image_data is None:
+            return None
+        try:
+            size = decodedSize(image_data)
+        except IOError as e:
+            logging.error(u"DeepZoom: page {0} of comic {1}: {2}".format(page_number, comic_id, str(e)))
+            return None
+        page_cache.put(path, name, u"{0}x{1}".format(*size).encode('ascii'))
+        return size
+
+    def getDescriptor(self, comic_id, page_number):
+        size = self.getPageSize(comic_id, page_number)
+        if size is None:
+            return None
+        return descriptor(*size)
+
+    def tileName(self, page_number, level, col, row):
+        return u"dzi:{0}:{1}:{2}_{3}".format(int(page_number), level, col, row)
+
+    def getCachedTile(self, comic_id, page_number, level, col, row):
+        if self.library.render_cache is not None:
+            key = self.library.makeRenderKey(comic_id, page_number, u"dzi{0}_{1}_{2}".format(level, col, row),
+                                             "jpeg")
+            return self.library.render_cache.get(key)
+        path = self.library.getComicPath(comic_id)
+        if path is None:
+            return None
+        return page_cache.get(path, self.tileName(page_number, level, col, row))
+
+    def putRow(self, comic_id, page_number, level, row, tiles):
+        path = self.library.getComicPath(comic_id)
+        for col, data in tiles.items():
+            if self.library.render_cache is not None:
+                key = self.library.makeRenderKey(comic_id, page_number,
+                                                 u"dzi{0}_{1}_{2}".format(level, col, row), "jpeg")
+                self.library.render_cache.put(key, data)
+            elif path is not None:
+                page_cache.put(path, self.tileName(page_number, level, col, row), data)
+
+    async def makeRow(self, comic_id, page_number, level, level_size, row):
+        image_data, image_type = await archive_pool.run(self.library.getComicPageData, comic_id, page_number)
+        if image_data is None:
+            return None
+        tiles = await image_pool.run(makeRowTiles, image_data, level_size[0], level_size[1], row,
+                                     pixels=imagePixels(image_data))
+        await archive_pool.run(self.putRow, comic_id, page_number, level, row, tiles)
+        return tiles
+
+    async def getTile(self, comic_id, page_number, level, col, row):
+        """A tile as JPEG data, None if there is no such tile"""
+        size = await archive_pool.run(self.getPageSize, comic_id, page_number)
+        if size is None or level < 0 or level >= levelCount(*size):
+            return None
+        level_size = levelSize(size[0], size[1], level)
+        (columns, rows) = tileGrid(*level_size)
+        if col < 0 or col >= columns or row < 0 or row >= rows:
+            return None
+
+        data = await archive_pool.run(self.getCachedTile, comic_id, page_number, level, col, row)
+        if data is not None:
+            return data
+
+        pending_key = (int(comic_id), int(page_number), level, row)
+        future = self.pending.get(pending_key)
+        if future is None:
+            future = asyncio.ensure_future(self.makeRow(comic_id, page_number, level, level_size, row))
+            self.pending[pending_key] = future
+            future.add_done_callback(lambda f: self.pending.pop(pending_key, None))
+        tiles = await asyncio.shield(future)
+        if tiles is None:
+            return None
+        return tiles.get(col)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer pool of image resize processes
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+import tornado.ioloop
+
+import comicstreamerlib.utils
+from comicapi.imagesize import getImageSize
+
+# images of more pixels than this take a slot of large_decodes
+LARGE_DECODE_PIXELS = 16 * 1000 * 1000
+
+
+def _initWorker(max_image_pixels, decode_budget):
+    comicstreamerlib.utils.setImageLimits(max_image_pixels, decode_budget)
+
+
+def imagePixels(image_data):
+    """Pixels in the image, from its header; 0 if they can't be told"""
+    info = getImageSize(image_data)
+    if info is None:
+        return 0
+    return info[1] * info[2]
+
+
+def _resizePage(max_height, image_data, image_format, quality, convert):
+    resized = comicstreamerlib.utils.resizeImage(max_height, image_data, image_format, quality, convert)
+    # no need to send back what the caller already has
+    if resized is image_data:
+        return None
+    return resized
+
+
+def _makeThumbnails(image_data, sizes):
+    return comicstreamerlib.utils.makeThumbnails(image_data, sizes)
+
+
+def _makeSprite(images, rects, sheet_size):
+    return comicstreamerlib.utils.makeSprite(images, rects, sheet_size)
+
+
+class ImagePool:
+    """
+    Decodes, resizes and encodes images in worker processes, so a big page
+    neither holds up the IOLoop nor waits on the GIL, and as many resizes
+    run at once as there are workers.  Zero workers means one per CPU.
+
+    Only large_decodes of the images over LARGE_DECODE_PIXELS are worked
+    on at any time, whatever the number of workers, which keeps the peak
+    memory of the workers in check.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.max_image_pixels = 0
+        self.decode_budget = 0
+        self.large_decodes = 2
+        self.large_semaphore = None
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def setWorkers(self, workers):
+        with self.lock:
+            self.workers = workers
+            self.shutdownExecutor(wait=False)
+
+    def setLimits(self, max_image_pixels, decode_budget, large_decodes):
+        comicstreamerlib.utils.setImageLimits(max_image_pixels, decode_budget)
+        with self.lock:
+            self.max_image_pixels = max_image_pixels
+            self.decode_budget = decode_budget
+            self.large_decodes = large_decodes
+            self.large_semaphore = None
+            self.shutdownExecutor(wait=False)
+
+    def getExecutor(self):
+        with self.lock:
+            if self.executor is None:
+                # don't fork a process that is running threads
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers or os.cpu_count() or 1,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_initWorker,
+                    initargs=(self.max_image_pixels, self.decode_budget))
+            return self.executor
+
+    def stop(self):
+        with self.lock:
+            self.shutdownExecutor()
+
+    # must be called with self.lock held
+    def shutdownExecutor(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def brokenExecutor(self, executor, e):
+        # a worker died, likely on a bad image; start over with a new pool
+        with self.lock:
+            if self.executor is executor:
+                self.shutdownExecutor(wait=False)
+        return IOError(u"Image worker died: {0}".format(str(e)))
+
+    async def run(self, func, *args, pixels=0):
+        """
+        Awaitable result of func(*args), from a worker.  pixels is the size
+        of the image it decodes, if it is worth knowing.
+        """
+        if pixels > LARGE_DECODE_PIXELS:
+            if self.large_semaphore is None:
+                self.large_semaphore = asyncio.Semaphore(self.large_decodes)
+            async with self.large_semaphore:
+                return await self.run(func, *args)
+
+        executor = self.getExecutor()
+        try:
+            return await tornado.ioloop.IOLoop.current().run_in_executor(executor, func, *args)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            raise self.brokenExecutor(executor, e)
+
+    def call(self, func, *args):
+        """Result of func(*args) from a worker, for threads off the IOLoop"""
+        executor = self.getExecutor()
+        try:
+            return executor.submit(func, *args).result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            raise self.brokenExecutor(executor, e)
+
+    async def resizePage(self, max_height, image_data, image_format='jpeg', quality=None, convert=False):
+        """
+        The page in image_format at most max_height high, or None if it
+        already fits and convert isn't set
+        """
+        return await self.run(_resizePage, max_height, image_data, image_format, quality, convert,
+                              pixels=imagePixels(image_data))
+
+    def makeThumbnails(self, image_data, sizes):
+        return self.call(_makeThumbnails, image_data, sizes)
+
+    async def makeSprite(self, images, rects, sheet_size):
+        return await self.run(_makeSprite, images, rects, sheet_size)
+
+
+image_pool = ImagePool()
@@ -4,25 +4,32 @@
 # Do not change the previous lines. See PEP 8, PEP 263.
 #
 """Encapsulates all data acces code to maintain the comic library"""
+import hashlib
 import logging
 import os
 from datetime import datetime
+from io import BytesIO
 
 import dateutil
+from PIL import Image
 from sqlalchemy import func, distinct
 from sqlalchemy.orm import subqueryload
 
 import comicstreamerlib.utils
-from comicapi.comicarchive import ComicArchive
+from comicapi.comicarchive import ComicArchive, RarArchiver, readMemberRange
+from comicapi.pagecache import page_cache
+from comicapi.imagesize import getImageSize, readImageSize
 from comicapi.issuestring import IssueString
 from comicstreamerlib.database import Comic, DatabaseInfo, Person, Role, Credit, Character, GenericTag, Team, Location, \
-    StoryArc, Genre, DeletedComic
+    StoryArc, Genre, DeletedComic, ComicPage, ComicThumbnail, makeVersion
 from comicstreamerlib.folders import AppFolders
 
 
 class Library:
-    def __init__(self, session_getter):
+    def __init__(self, session_getter, render_cache=None, thumbnail_store=None):
         self.getSession = session_getter
+        self.render_cache = render_cache
+        self.thumbnail_store = thumbnail_store
         self.comicArchiveList = []
         self.namedEntities = {}
 
@@ -30,40 +37,238 @@ class Library:
         """SQLAlchemy session"""
         pass
 
-    def getComicThumbnail(self, comic_id):
+    def getComicThumbnailKey(self, comic_id, size=200):
+        """Store key of a comic thumbnail, the one of the size nearest to size"""
+        return self.getSession().query(ComicThumbnail.key) \
+            .filter(ComicThumbnail.comic_id == int(comic_id)) \
+            .order_by(func.abs(ComicThumbnail.size - int(size)), ComicThumbnail.size.desc()) \
+            .limit(1).scalar()
+
+    def getComicThumbnailKeys(self, comic_ids, size=200):
+        """Like getComicThumbnailKey(), for several comics at once, by comic id"""
+        best = {}
+        for comic_id, thumb_size, key in self.getSession() \
+                .query(ComicThumbnail.comic_id, ComicThumbnail.size, ComicThumbnail.key) \
+                .filter(ComicThumbnail.comic_id.in_([int(i) for i in comic_ids])):
+            distance = (abs(thumb_size - int(size)), -thumb_size)
+            if comic_id not in best or distance < best[comic_id][0]:
+                best[comic_id] = (distance, key)
+        return dict((comic_id, key) for comic_id, (distance, key) in best.items())
+
+    def getThumbnailSheet(self, comic_ids, size=200, columns=10):
+        """
+        The layout of a sprite sheet of the thumbnails of comic_ids, as
+        (sheet key, [(comic id, thumbnail key, (x, y, width, height))],
+        (sheet width, sheet height)).  Comics without a thumbnail are left
+        out.  The sheet key is made from the thumbnails' keys, so it changes
+        whenever one of them does.
+        """
+        keys = self.getComicThumbnailKeys(comic_ids, size)
+        tiles = []
+        dims = []
+        for comic_id in comic_ids:
+            key = keys.get(int(comic_id))
+            if key is None:
+                continue
+            try:
+                with open(self.thumbnail_store.pathFor(key), 'rb') as f:
+                    info = readImageSize(f)
+            except (OSError, IOError):
+                info = None
+            if info is not None:
+                tiles.append((int(comic_id), key))
+                dims.append(info[1:])
+
+        rects, sheet_size = comicstreamerlib.utils.spriteLayout(dims, columns)
+        text = u"{0}:{1}".format(columns, u",".join(key for (comic_id, key) in tiles))
+        sheet_key = hashlib.sha1(text.encode("UTF-8")).hexdigest()
+        return sheet_key, [tile + (rect,) for tile, rect in zip(tiles, rects)], sheet_size
+
+    def getComicThumbnail(self, comic_id, size=200):
         """Fast access to a comic thumbnail"""
-        return self.getSession().query(Comic.thumbnail) \
-            .filter(Comic.id == int(comic_id)).scalar()
+        key = self.getComicThumbnailKey(comic_id, size)
+        if key is None:
+            return None
+        return self.thumbnail_store.get(key)
+
+    def pruneThumbnails(self):
+        """Remove stored thumbnails no comic uses anymore"""
+        keep = set(key for (key,) in self.getSession().query(ComicThumbnail.key).distinct())
+        removed = self.thumbnail_store.prune(keep)
+        self.getSession().commit()
+        return removed
 
     def getComic(self, comic_id):
         return self.getSession().query(Comic).get(int(comic_id))
 
-    def getComicPage(self, comic_id, page_number, max_height=None):
+    def getComicPage(self, comic_id, page_number, max_height=None, image_format='jpeg', quality=None,
+                     convert=False):
+        """The page's image data and its MIME type, if known"""
+        mime_type = comicstreamerlib.utils.image_formats[image_format][1]
+        if max_height is not None or convert:
+            image_data = self.getRenderedPage(comic_id, page_number, max_height, image_format, quality)
+            if image_data is not None:
+                return image_data, mime_type
+
+        image_data, image_type = self.getComicPageData(comic_id, page_number)
+        if image_data is None:
+            return self.getDefaultPage()
+
+        # resize image
+        if max_height is not None or convert:
+            try:
+                resized = comicstreamerlib.utils.resizeImage(
+                    max_height and int(max_height), image_data, image_format, quality, convert)
+                if resized is not image_data:
+                    image_data, image_type = resized, mime_type
+                    self.putRenderedPage(comic_id, page_number, max_height, image_format, quality, image_data)
+            except Exception as e:
+                logging.exception(e)
+                pass
+        return image_data, image_type
+
+    def getComicPageData(self, comic_id, page_number, keep=False):
+        """
+        The page's image data as it is in the archive, and its MIME type if
+        known.  (None, None) if the page can't be read.  With keep, the
+        data is put in the page cache for the next time.
+        """
         (path, page_count) = self.getSession().query(Comic.path, Comic.page_count) \
             .filter(Comic.id == int(comic_id)).first()
 
         image_data = None
-        default_img_file = AppFolders.imagePath("default.jpg")
+        image_type = None
 
         if path is not None:
             if int(page_number) < page_count:
-                ca = self.getComicArchive(path)
-                image_data = ca.getPage(int(page_number))
+                # the scanner noted where the page is, so try reading it
+                # from there before opening the archive
+                entry = self.getSession().query(ComicPage) \
+                    .filter(ComicPage.comic_id == int(comic_id)) \
+                    .filter(ComicPage.page == int(page_number)).first()
+                if entry is not None:
+                    image_type = entry.image_type
+                    image_data = page_cache.get(path, entry.name)
+                    if image_data is None and entry.compression is not None:
+                        try:
+                            image_data = readMemberRange(path, entry.offset, entry.compress_size,
+                                                         entry.size, entry.crc, entry.compression)
+                        except (OSError, IOError) as e:
+                            logging.error(u"getComicPageData(): [{0}] {1}:{2}".format(str(e), path, entry.name))
+
+                if image_data is None:
+                    ca = self.getComicArchive(path)
+                    image_data = ca.getPage(int(page_number))
+
+                if keep and image_data is not None and entry is not None:
+                    page_cache.put(path, entry.name, image_data)
 
         if image_data is None:
-            with open(default_img_file, 'rb') as fd:
-                image_data = fd.read()
-            return image_data
+            return None, None
+        return image_data, image_type
+
+    def getDefaultPage(self):
+        """Image data and MIME type of what's shown for an unreadable page"""
+        with open(AppFolders.imagePath("default.jpg"), 'rb') as fd:
+            return fd.read(), 'image/jpeg'
+
+    def makeRenderKey(self, comic_id, page_number, size, variant):
+        """Render cache key of a page, or of the thumbnail if page_number is None"""
+        if self.render_cache is None:
+            return None
+        mod_ts = self.getSession().query(Comic.mod_ts) \
+            .filter(Comic.id == int(comic_id)).scalar()
+        page = u"thumbnail" if page_number is None else int(page_number)
+        return self.render_cache.makeKey(comic_id, page, size, variant, mod_ts)
+
+    def getRenderKey(self, comic_id, page_number, max_height, image_format, quality):
+        size = u"orig" if max_height is None else u"h{0}".format(int(max_height))
+        variant = image_format if quality is None else u"{0}q{1}".format(image_format, int(quality))
+        return self.makeRenderKey(comic_id, page_number, size, variant)
+
+    def getRenderedPage(self, comic_id, page_number, max_height, image_format='jpeg', quality=None):
+        """A resize or conversion of the page done before, if it was kept"""
+        render_key = self.getRenderKey(comic_id, page_number, max_height, image_format, quality)
+        if render_key is None:
+            return None
+        return self.render_cache.get(render_key)
+
+    def hasRenderedPage(self, comic_id, page_number, max_height, image_format='jpeg', quality=None):
+        render_key = self.getRenderKey(comic_id, page_number, max_height, image_format, quality)
+        return render_key is not None and self.render_cache.has(render_key)
+
+    def putRenderedPage(self, comic_id, page_number, max_height, image_format, quality, image_data):
+        render_key = self.getRenderKey(comic_id, page_number, max_height, image_format, quality)
+        if render_key is not None:
+            self.render_cache.put(render_key, image_data)
+
+    def getComicPageCount(self, comic_id):
+        return self.getSession().query(Comic.page_count) \
+            .filter(Comic.id == int(comic_id)).scalar() or 0
+
+    def getComicVersion(self, comic_id):
+        """(version, mod_ts) of the comic's file, None if there's no such comic"""
+        row = self.getSession().query(Comic.mod_ts, Comic.filesize) \
+            .filter(Comic.id == int(comic_id)).first()
+        if row is None or row[0] is None:
+            return None
+        return makeVersion(row[0], row[1]), row[0]
 
-        # resize image
-        if max_height is not None:
-            try:
-                image_data = comicstreamerlib.utils.resizeImage(
-                    int(max_height), image_data)
-            except Exception as e:
-                logging.exception(e)
-                pass
-        return image_data
+    def getComicPath(self, comic_id):
+        return self.getSession().query(Comic.path) \
+            .filter(Comic.id == int(comic_id)).scalar()
+
+    def getComicPageSize(self, comic_id, page_number):
+        """(width, height) of a page, None if it can't be read"""
+        row = self.getSession().query(ComicPage.width, ComicPage.height) \
+            .filter(ComicPage.comic_id == int(comic_id)) \
+            .filter(ComicPage.page == int(page_number)).first()
+        if row is not None and row[0] is not None and row[1] is not None:
+            return row
+
+        # not noted by the scanner, so read the image's header
+        image_data, image_type = self.getComicPageData(comic_id, page_number)
+        if image_data is None:
+            return None
+        info = getImageSize(image_data)
+        if info is not None:
+            return info[1:]
+        try:
+            return Image.open(BytesIO(image_data)).size
+        except (OSError, IOError, Image.DecompressionBombError):
+            return None
+
+    def getComicPages(self, comic_id):
+        """The page table of a comic, in reading order"""
+        return self.getSession().query(ComicPage.page, ComicPage.image_type, ComicPage.size,
+                                       ComicPage.width, ComicPage.height) \
+            .filter(ComicPage.comic_id == int(comic_id)) \
+            .order_by(ComicPage.page).all()
+
+    def getComicPageRange(self, comic_id, page_number):
+        """
+        (path, offset, length, image_type) of a page stored uncompressed in
+        its file, so it can be sent straight from there.  None if it isn't,
+        or if the file changed since it was scanned.
+        """
+        row = self.getSession().query(Comic.path, Comic.mod_ts, Comic.filesize,
+                                      ComicPage.offset, ComicPage.size, ComicPage.image_type) \
+            .join(ComicPage, ComicPage.comic_id == Comic.id) \
+            .filter(Comic.id == int(comic_id)) \
+            .filter(ComicPage.page == int(page_number)) \
+            .filter(ComicPage.compression == 'stored') \
+            .filter(ComicPage.size > 0).first()
+        if row is None:
+            return None
+
+        (path, mod_ts, filesize, offset, size, image_type) = row
+        try:
+            statinfo = os.stat(path)
+        except OSError:
+            return None
+        if statinfo.st_size != filesize or datetime.utcfromtimestamp(statinfo.st_mtime) != mod_ts:
+            return None
+        return path, offset, size, image_type
 
     def getStats(self):
         stats = {}
@@ -130,7 +335,10 @@ class Library:
         comic.mod_ts = md.mod_ts
         comic.hash = md.hash
         comic.filesize = md.filesize
-        comic.thumbnail = md.thumbnail
+        comic.thumbnails_raw = [ComicThumbnail(size=size, key=self.thumbnail_store.put(data))
+                                for size, data in md.thumbnails.items()]
+        comic.rar_index = md.rar_index
+        comic.pages_raw = self.createPageRows(md.page_table)
 
         if not md.isEmpty:
             if md.series is not None:
@@ -174,6 +382,20 @@ class Library:
 
         return comic
 
+    def createPageRows(self, page_table, comic_id=None):
+        return [ComicPage(comic_id=comic_id,
+                          page=i,
+                          name=entry.name,
+                          offset=entry.offset,
+                          compress_size=entry.compress_size,
+                          size=entry.size,
+                          crc=entry.crc,
+                          compression=entry.compression,
+                          image_type=entry.image_type,
+                          width=entry.width,
+                          height=entry.height)
+                for i, entry in enumerate(page_table)]
+
     # Will update the comic object with relationship objects based on metadata
     def update_comic_meta(self, comic, md):
 
@@ -297,6 +519,28 @@ class Library:
             s.rollback()
             raise
 
+    def moveComic(self, comic_id, path, page_table):
+        """Point a comic at a new file with the same pages, keeping its id and bookmark"""
+        s = self.getSession()
+        try:
+            comic = s.query(Comic).get(int(comic_id))
+            comic.folder, comic.file = os.path.split(path)
+            comic.path = path
+            comic.mod_ts = datetime.utcfromtimestamp(os.path.getmtime(path))
+            comic.filesize = os.path.getsize(path)
+            comic.rar_index = None
+
+            s.query(ComicPage).filter(ComicPage.comic_id == comic.id).delete(synchronize_session=False)
+            s.expire(comic, ['pages_raw'])
+            s.add_all(self.createPageRows(page_table, comic.id))
+
+            self._dbUpdated()
+            s.commit()
+        except Exception as e:
+            logging.exception(e)
+            s.rollback()
+            raise
+
     def deleteComics(self, comic_id_list):
         s = self.getSession()
         try:
@@ -563,6 +807,12 @@ class Library:
                 self.comicArchiveList.append(ca)
                 return ca
         else:
+            # a RAR member index saved by the scanner spares listing the archive
+            rar_index = self.getSession().query(Comic.rar_index) \
+                .filter(Comic.path == path).scalar()
+            if rar_index is not None:
+                RarArchiver.seedIndex(path, rar_index)
+
             ca = ComicArchive(
                 path, default_image_path=AppFolders.imagePath("default.jpg"))
             self.comicArchiveList.append(ca)
@@ -22,6 +22,7 @@ limitations under the License.
 
 import logging
 import logging.handlers
+import multiprocessing
 import os
 import platform
 import signal
@@ -86,8 +87,10 @@ class Launcher:
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
 
-        bonjour = BonjourThread(self.apiServer.port)
-        bonjour.start()
+        # with several server processes, only one announces the service
+        if self.apiServer.isMainProcess():
+            bonjour = BonjourThread(self.apiServer.port)
+            bonjour.start()
 
         if getattr(sys, 'frozen', None):
             # A frozen app will run a GUI
@@ -112,4 +115,6 @@ class Launcher:
 
 
 def main():
+    # image and PDF workers are spawned, which frozen builds must allow for
+    multiprocessing.freeze_support()
     Launcher().go()
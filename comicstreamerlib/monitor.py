@@ -16,6 +16,7 @@ from watchdog.observers import Observer
 import comicstreamerlib.utils
 from comicapi.comicarchive import *
 from comicstreamerlib.database import *
+from comicstreamerlib.imagepool import image_pool
 from comicstreamerlib.library import Library
 
 
@@ -39,6 +40,7 @@ class Monitor:
         self.paths = paths
         self.eventList = []
         self.mutex = threading.Lock()
+        self.scan_lock = threading.Lock()
         self.eventProcessingTimer = None
         self.quit_when_done = False  # for debugging/testing
         self.status = "IDLE"
@@ -60,7 +62,7 @@ class Monitor:
             global args
             logging.debug("Monitor: started main loop.")
             self.session = self.dm.Session()
-            self.library = Library(self.dm.Session)
+            self.library = Library(self.dm.Session, thumbnail_store=self.dm.thumbnail_store)
 
             observer = Observer()
             self.eventHandler = MonitorEventHandler(self)
@@ -93,17 +95,19 @@ class Monitor:
         if msg is None:
             return
 
-        # dispatch messages
-        if msg == "scan":
-            try:
-                self.dofullScan(self.paths)
-            except Exception as e:
-                logging.exception(e)
-        if msg == "events":
-            try:
-                self.doEventProcessing(args)
-            except Exception as e:
-                logging.exception(e)
+        # dispatch messages; the transcoder swaps files and database rows
+        # while holding the lock, so nothing is handled in between
+        with self.scan_lock:
+            if msg == "scan":
+                try:
+                    self.dofullScan(self.paths)
+                except Exception as e:
+                    logging.exception(e)
+            if msg == "events":
+                try:
+                    self.doEventProcessing(args)
+                except Exception as e:
+                    logging.exception(e)
 
     def scan(self):
         self.queue.put(("scan", None))
@@ -172,6 +176,8 @@ class Monitor:
     def getComicMetadata(self, path):
         ca = ComicArchive(path, default_image_path=AppFolders.imagePath("default.jpg"))
         logging.debug(u"checking path {0}\r".format(path))
+        # read everything below in one pass over the archive
+        probe = ca.probe()
         if ca.seemsToBeAComicArchive():
             logging.debug(u"Reading in {0} {1}\r".format(self.read_count, path))
             sys.stdout.flush()
@@ -195,13 +201,24 @@ class Monitor:
             md.mod_ts = datetime.utcfromtimestamp(os.path.getmtime(ca.path))
             md.filesize = os.path.getsize(md.path)
             md.hash = ""
+            md.page_table = probe.pages
 
-            # thumbnail generation
-            image_data = ca.getPage(0)
-            # now resize it
-            thumb = BytesIO()
-            comicstreamerlib.utils.resize(image_data, (200, 200), thumb)
-            md.thumbnail = thumb.getvalue()
+            # keep the RAR member index, so the server never has to rebuild it
+            md.rar_index = None
+            if ca.isRar():
+                index = ca.archiver.getIndex()
+                if index is not None:
+                    md.rar_index = index.toJson()
+
+            # thumbnail generation, all sizes from one decode, in an image
+            # worker, as the scan shares the GIL with the server
+            try:
+                md.thumbnails = image_pool.makeThumbnails(probe.first_page,
+                                                          comicstreamerlib.utils.thumbnail_sizes)
+            except IOError as e:
+                # e.g. a cover over the pixel limit; the comic is still added
+                logging.error(u"Monitor: no thumbnail for {0}: {1}".format(path, str(e)))
+                md.thumbnails = {}
 
             return md
         return None
@@ -268,6 +285,9 @@ class Monitor:
                              logging.INFO)
         if len(to_remove) > 0:
             self.library.deleteComics(to_remove)
+            # only the scan adds thumbnails, so none can be on the way in
+            removed = self.library.pruneThumbnails()
+            logging.debug(u"Monitor: removed {0} unused thumbnails".format(removed))
 
         self.setStatusDetail(u"Monitor: {0} new files to scan...".format(
             len(filelist)), logging.INFO)
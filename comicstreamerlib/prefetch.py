@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer read-ahead of pages for readers going page by page
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import collections
+import logging
+
+from comicstreamerlib.imagepool import image_pool
+from comicstreamerlib.workerpool import db_pool, archive_pool
+
+# readers followed at once, the least recently seen are forgotten first
+MAX_READERS = 256
+
+
+class Reader:
+    """Where one client is in one comic, and what is being got ready for it"""
+
+    def __init__(self, page_number, render_args):
+        self.page_number = page_number
+        self.render_args = render_args
+        self.next_page = page_number + 1
+        self.last_page = page_number
+        self.task = None
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+class Prefetcher:
+    """
+    Follows the pages clients ask for and, once one goes through a comic
+    page after page, gets the next few ready in the background: resized
+    the same way into the render cache, or else just extracted into the
+    page cache.  A reader jumping elsewhere cancels what was being got
+    ready for them.
+    """
+
+    def __init__(self, library, depth=3):
+        self.library = library
+        self.depth = depth
+        self.readers = collections.OrderedDict()
+
+    def notePage(self, client, comic_id, page_number, max_height=None, image_format='jpeg', quality=None,
+                 convert=False):
+        """Called on the IOLoop for every page sent"""
+        if self.depth <= 0:
+            return
+        key = (client, int(comic_id))
+        page_number = int(page_number)
+        render_args = (max_height, image_format, quality, convert)
+
+        reader = self.readers.pop(key, None)
+        if reader is not None and reader.page_number == page_number and reader.render_args == render_args:
+            # asked again, nothing new
+            self.readers[key] = reader
+            return
+
+        if reader is None or reader.page_number + 1 != page_number or reader.render_args != render_args:
+            if reader is not None:
+                reader.cancel()
+            reader = Reader(page_number, render_args)
+        else:
+            reader.page_number = page_number
+            reader.last_page = page_number + self.depth
+            reader.next_page = max(reader.next_page, page_number + 1)
+            if reader.task is None or reader.task.done():
+                reader.task = asyncio.ensure_future(self.prefetch(int(comic_id), reader))
+
+        self.readers[key] = reader
+        while len(self.readers) > MAX_READERS:
+            old_key, old_reader = self.readers.popitem(last=False)
+            old_reader.cancel()
+
+    async def prefetch(self, comic_id, reader):
+        page_count = await db_pool.run(self.library.getComicPageCount, comic_id)
+        while reader.next_page <= min(reader.last_page, page_count - 1):
+            page_number = reader.next_page
+            reader.next_page += 1
+            try:
+                await self.warmPage(comic_id, page_number, *reader.render_args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(u"Prefetcher: page {0} of comic {1}: {2}".format(page_number, comic_id, str(e)))
+                return
+
+    async def warmPage(self, comic_id, page_number, max_height, image_format, quality, convert):
+        library = self.library
+        if (max_height is not None or convert) and library.render_cache is not None:
+            if await archive_pool.run(library.hasRenderedPage, comic_id, page_number, max_height, image_format,
+                                      quality):
+                return
+            image_data, image_type = await archive_pool.run(library.getComicPageData, comic_id, page_number)
+            if image_data is None:
+                return
+            resized = await image_pool.resizePage(max_height, image_data, image_format, quality, convert)
+            if resized is not None:
+                await archive_pool.run(library.putRenderedPage, comic_id, page_number, max_height, image_format,
+                                       quality, resized)
+        elif await archive_pool.run(library.getComicPageRange, comic_id, page_number) is None:
+            # pages that go straight from the file need nothing done
+            await archive_pool.run(library.getComicPageData, comic_id, page_number, True)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer serving from several processes sharing one socket
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import tornado.netutil
+import tornado.process
+
+
+def processCount(setting):
+    """Processes to serve from for the processes setting; 0 is one per CPU"""
+    if setting == 1 or not hasattr(os, 'fork') or getattr(sys, 'frozen', None):
+        return 1
+    return setting or os.cpu_count() or 1
+
+
+def bindPort(port, tries=5):
+    """
+    Listening sockets for the port.  The processes of a server that is
+    restarting can hold on to it for a moment, so a port in use is tried
+    again a few times before giving up.
+    """
+    while True:
+        try:
+            return tornado.netutil.bind_sockets(port)
+        except OSError as e:
+            tries -= 1
+            if e.errno != errno.EADDRINUSE or tries <= 0:
+                raise
+            logging.info(u"Port {0} is in use, trying again".format(port))
+            time.sleep(1)
+
+
+def forkServers(count):
+    """
+    Fork count serving processes and return the task id, 0 to count - 1,
+    in each of them.  The calling process never returns; it stays to start
+    again any that die, and exits once they have all quit.
+    """
+    return tornado.process.fork_processes(count)
+
+
+class SharedState:
+    """
+    A small JSON-able value that one process sets and the others read,
+    kept in shared memory that must be made before the fork.
+    """
+
+    def __init__(self, size=4096):
+        self.array = multiprocessing.Array('c', size)
+
+    def set(self, value):
+        data = json.dumps(value).encode('utf-8')
+        if len(data) >= len(self.array):
+            logging.error(u"SharedState: value of {0} bytes doesn't fit".format(len(data)))
+            return
+        with self.array.get_lock():
+            self.array.value = data
+
+    def get(self, default=None):
+        with self.array.get_lock():
+            data = self.array.value
+        if not data:
+            return default
+        return json.loads(data.decode('utf-8'))
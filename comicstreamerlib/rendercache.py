@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer on-disk cache of resized pages
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+
+class RenderCache:
+    """
+    Pages as they come out of a resize, kept on disk and named by a hash
+    of what went into them: comic, page, target size, output format and
+    the mtime of the comic's file.  A changed file thus never hits, and
+    its old renders just age out.
+
+    Least recently used renders are removed once the files add up to more
+    than max_bytes.  Use order is kept in memory, and in the files' mtimes
+    so it survives a restart.
+
+    With shared set, other processes use the folder too, each with its own
+    share of the space: renders they made are picked up from disk, and
+    renders they removed are just misses.  Processes forked after the
+    renders on disk were loaded split them up with takeShare().
+    """
+
+    def __init__(self, folder, max_bytes, shared=False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        found = []
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    statinfo = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith(".tmp"):
+                    # left over from an interrupted write
+                    os.remove(path)
+                else:
+                    found.append((statinfo.st_mtime, name, statinfo.st_size))
+
+        with self.lock:
+            for mtime, key, size in sorted(found):
+                self.entries[key] = size
+                self.current_bytes += size
+            self.evict()
+
+    def takeShare(self, share, shares):
+        """
+        Keep just the share-th of shares parts of the renders known so far,
+        and of the space, so that processes forked with the same index
+        don't each age out all of them.  The rest are still used, picked up
+        from disk like those made by the other processes.
+        """
+        with self.lock:
+            self.max_bytes //= shares
+            for key in list(self.entries):
+                if int(key[:8], 16) % shares != share:
+                    self.current_bytes -= self.entries.pop(key)
+            self.evict()
+
+    @staticmethod
+    def makeKey(comic_id, page_number, size, image_format, mod_ts):
+        text = u"{0}:{1}:{2}:{3}:{4}".format(comic_id, page_number, size, image_format, mod_ts)
+        return hashlib.sha1(text.encode("UTF-8")).hexdigest()
+
+    def pathFor(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def has(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+        return self.shared and os.path.exists(self.pathFor(key))
+
+    def get(self, key):
+        with self.lock:
+            known = key in self.entries
+            if known:
+                self.entries.move_to_end(key)
+            elif not self.shared:
+                self.misses += 1
+                return None
+
+        path = self.pathFor(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (OSError, IOError):
+            with self.lock:
+                self.misses += 1
+                size = self.entries.pop(key, None)
+                if size is not None:
+                    self.current_bytes -= size
+            return None
+
+        with self.lock:
+            self.hits += 1
+            if not known and key not in self.entries:
+                # made by another process, and now ours to age out
+                self.entries[key] = len(data)
+                self.current_bytes += len(data)
+                self.evict()
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self.pathFor(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write aside and rename, so a reader never sees half a file
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, path)
+        except (OSError, IOError) as e:
+            logging.error(u"RenderCache: couldn't write {0}: {1}".format(path, str(e)))
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old
+            self.entries[key] = len(data)
+            self.current_bytes += len(data)
+            self.evict()
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    # must be called with self.lock held
+    def evict(self):
+        while self.current_bytes > self.max_bytes and len(self.entries) > 0:
+            key, size = self.entries.popitem(last=False)
+            self.current_bytes -= size
+            try:
+                os.remove(self.pathFor(key))
+            except OSError:
+                pass
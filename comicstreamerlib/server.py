@@ -20,12 +20,23 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
+import collections
+import email.utils
 import mimetypes
+import mmap
+import multiprocessing
+import signal
 import urllib.parse
 from io import BytesIO
 
+from datetime import timezone
+
 import tornado.escape
+import tornado.httpserver
+import tornado.httputil
 import tornado.ioloop
+import tornado.iostream
 import tornado.web
 from sqlalchemy.orm import subqueryload
 
@@ -33,7 +44,6 @@ try:
     from PIL import WebPImagePlugin
 except:
     pass
-import gzip
 import dateutil.parser
 import logging.handlers
 import imghdr
@@ -48,11 +58,17 @@ from comicstreamerlib.database import *
 from comicstreamerlib.monitor import Monitor
 from comicstreamerlib.folders import AppFolders
 from comicstreamerlib.bookmarker import Bookmarker
+from comicstreamerlib.transcoder import Transcoder
+from comicstreamerlib.rendercache import RenderCache
+from comicstreamerlib.imagepool import image_pool
+from comicstreamerlib.workerpool import db_pool, archive_pool
+from comicstreamerlib.compression import compressor, chooseEncoding, isCompressible, MIN_SIZE, INLINE_SIZE
+from comicstreamerlib.deepzoom import DeepZoom
+from comicstreamerlib.prefetch import Prefetcher
+from comicstreamerlib.prefork import processCount, bindPort, forkServers, SharedState
 
 from comicstreamerlib.library import Library
 
-Image.MAX_IMAGE_PIXELS = None  # Removed image size limit for testing
-
 
 # add webp test to imghdr in case it isn't there already
 def my_test_webp(h):
@@ -73,6 +89,12 @@ def fix_username(username):
         return (username + "XX").encode()
 
 
+async def getDigest(password):
+    # the digest is slow on purpose, so it's made off the IOLoop
+    return await tornado.ioloop.IOLoop.current().run_in_executor(None, comicstreamerlib.utils.getDigest,
+                                                                 password)
+
+
 def custom_get_current_user(handler):
     user = handler.get_secure_cookie("user")
     if user:
@@ -81,6 +103,11 @@ def custom_get_current_user(handler):
 
 
 class BaseHandler(tornado.web.RequestHandler):
+    # whether a compressed body is worth keeping for the next time the
+    # same one is sent, as for lists that are asked for again and again
+    keep_compressed = False
+    finishing = None
+
     @property
     def webroot(self):
         return self.application.webroot
@@ -92,6 +119,58 @@ class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self):
         return custom_get_current_user(self)
 
+    def finish(self, chunk=None):
+        # a body being compressed off the IOLoop is sent once that is done
+        if self.finishing is not None:
+            return self.finishing
+        if chunk is not None:
+            self.write(chunk)
+        encoding = self.negotiateEncoding()
+        if encoding is None:
+            return super().finish()
+        body = b"".join(self._write_buffer)
+        if len(body) <= INLINE_SIZE:
+            try:
+                self.setEncodedBody(compressor.compress(body, encoding, self.keep_compressed), encoding)
+            except Exception as e:
+                logging.error(u"Couldn't compress {0}: {1}".format(self.request.uri, str(e)))
+            return super().finish()
+        self.finishing = asyncio.ensure_future(self.finishCompressed(body, encoding))
+        return self.finishing
+
+    async def finishCompressed(self, body, encoding):
+        # nobody awaits this, so whatever happens the response must go out
+        try:
+            compressed = await compressor.compressAsync(body, encoding, self.keep_compressed)
+            self.setEncodedBody(compressed, encoding)
+        except Exception as e:
+            # sent as it is instead
+            logging.error(u"Couldn't compress {0}: {1}".format(self.request.uri, str(e)))
+        try:
+            await super().finish()
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception as e:
+            logging.exception(e)
+
+    def negotiateEncoding(self):
+        """The encoding to compress the response with, None to send it as is"""
+        if (self._headers_written or self.get_status() != 200 or self.request.method == "HEAD"
+                or "Content-Encoding" in self._headers or not isCompressible(self._headers.get("Content-Type"))):
+            return None
+        self.add_header("Vary", "Accept-Encoding")
+        if sum(len(part) for part in self._write_buffer) < MIN_SIZE:
+            return None
+        return self.acceptedEncoding()
+
+    def acceptedEncoding(self):
+        return chooseEncoding(self.request.headers.get("Accept-Encoding"), compressor.getEncodings())
+
+    def setEncodedBody(self, data, encoding):
+        self._write_buffer = [data]
+        self.set_header("Content-Encoding", encoding)
+        self.clear_header("Content-Length")
+
 
 class GenericAPIHandler(BaseHandler):
     def validateAPIKey(self):
@@ -102,10 +181,51 @@ class GenericAPIHandler(BaseHandler):
             else:
                 raise tornado.web.HTTPError(400)
 
+    def setCacheHeaders(self, etag, mod_ts=None, version=None):
+        """
+        Validators for what is about to be sent, so a client can check its
+        copy instead of fetching it again.  A URL with a v argument equal to
+        version only ever gets this content, so it can be kept for good.
+        True if the client's copy is current and a 304 is all it gets.
+        """
+        self.set_header("Etag", u'"{0}"'.format(etag))
+        if mod_ts is not None:
+            self.set_header("Last-Modified", mod_ts)
+        if version is not None and self.get_argument(u"v", default=None) == version:
+            self.set_header("Cache-Control", "private, max-age=31536000, immutable")
+        else:
+            self.set_header("Cache-Control", "private, no-cache")
+
+        if "If-None-Match" in self.request.headers:
+            not_modified = self.check_etag_header()
+        else:
+            not_modified = mod_ts is not None and self.isNotModifiedSince(mod_ts)
+        if not_modified:
+            self.set_status(304)
+        return not_modified
+
+    def isNotModifiedSince(self, mod_ts):
+        since = self.request.headers.get("If-Modified-Since")
+        if since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        return mod_ts.replace(microsecond=0) <= since
+
+    def clearCacheHeaders(self):
+        # for stand-ins, like the default page, that mustn't be kept
+        self.clear_header("Etag")
+        self.clear_header("Last-Modified")
+        self.set_header("Cache-Control", "no-cache")
+
 
 class JSONResultAPIHandler(GenericAPIHandler):
     def setContentType(self):
-        self.add_header("Content-type", "application/json; charset=UTF-8")
+        self.set_header("Content-type", "application/json; charset=UTF-8")
 
     def processPagingArgs(self, query):
         per_page = self.get_argument(u"per_page", default=None)
@@ -340,19 +460,19 @@ class JSONResultAPIHandler(GenericAPIHandler):
 
 
 class ZippableAPIHandler(JSONResultAPIHandler):
+    keep_compressed = True
+
+    def acceptedEncoding(self):
+        encoding = super().acceptedEncoding()
+        # clients from before Accept-Encoding was looked at ask with ?gzip
+        if encoding is None and "Accept-Encoding" not in self.request.headers \
+                and self.get_argument(u"gzip", default=None) is not None:
+            encoding = "gzip"
+        return encoding
+
     def writeResults(self, json_data):
         self.setContentType()
-        if self.get_argument(u"gzip", default=None) is not None:
-            self.add_header("Content-Encoding", "gzip")
-            # TODO: make sure browser can handle gzip?
-            zbuf = StringIO()
-            zfile = gzip.GzipFile(mode='wb', fileobj=zbuf, compresslevel=9)
-            zfile.write(json.dumps(json_data))
-            zfile.close()
-
-            self.write(zbuf.getvalue())
-        else:
-            self.write(json_data)
+        self.write(json_data)
 
 
 class CommandAPIHandler(GenericAPIHandler):
@@ -370,13 +490,116 @@ class CommandAPIHandler(GenericAPIHandler):
             self.application.shutdown()
 
 
+# files written to more lately than this, in seconds, are read rather than
+# mapped, as they may still be being written to
+MMAP_MIN_AGE = 60
+
+
+def mapFileRange(path, offset, length):
+    """
+    length bytes of the file at offset, as a view of a mapping of the file,
+    so the data is never copied into a python object on the way out.  None
+    if the file is now shorter than that.
+
+    A mapped file that some other program truncates takes the process down
+    with SIGBUS the moment a lost page is touched, and taggers do rewrite
+    comics in place.  So the length is checked once the file is open, and
+    a file written to lately is read instead.
+    """
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(path, 'rb') as f:
+        statinfo = os.fstat(f.fileno())
+        if statinfo.st_size < offset + length:
+            return None
+        if time.time() - statinfo.st_mtime < MMAP_MIN_AGE:
+            f.seek(offset)
+            data = f.read(length)
+            if len(data) != length:
+                return None
+            return memoryview(data)
+        # the mapping stays valid after the file is closed, and is
+        # unmapped once the last view of it is gone
+        mapped = mmap.mmap(f.fileno(), offset - start + length, access=mmap.ACCESS_READ, offset=start)
+    return memoryview(mapped)[offset - start:offset - start + length]
+
+
 class ImageAPIHandler(GenericAPIHandler):
     def setContentType(self, image_data):
         if type(image_data) is bytes:
             imtype = imghdr.what(BytesIO(image_data))
-            self.add_header("Content-type", "image/{0}".format(imtype))
+            self.set_header("Content-type", "image/{0}".format(imtype))
+        elif "/" in image_data:
+            self.set_header("Content-type", image_data)
         else:
-            self.add_header("Content-type", "image/{0}".format(image_data))
+            self.set_header("Content-type", "image/{0}".format(image_data))
+
+    def getOutputFormat(self):
+        """
+        (format, quality, convert) for images this request gets encoded:
+        the format argument if given, else the best the Accept header allows.
+        convert is set if the client asked for a format or quality outright.
+        """
+        formats = comicstreamerlib.utils.getImageFormats()
+
+        quality = self.get_argument(u"quality", default=None)
+        if quality is not None:
+            try:
+                quality = min(max(int(quality), 1), 100)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Bad quality")
+
+        image_format = self.get_argument(u"format", default=None)
+        if image_format is not None:
+            image_format = image_format.lower().replace("jpg", "jpeg")
+            if image_format not in formats:
+                raise tornado.web.HTTPError(400, "Unsupported format")
+            return image_format, quality, True
+
+        # the vary header lets caches keep a copy per format
+        self.set_header("Vary", "Accept")
+        accepted = {}
+        for item in self.request.headers.get("Accept", "").split(","):
+            params = item.strip().lower().split(";")
+            q = 1.0
+            for param in params[1:]:
+                param = param.strip()
+                if param.startswith("q="):
+                    try:
+                        q = float(param[2:])
+                    except ValueError:
+                        pass
+            accepted[params[0].strip()] = q
+
+        def weight(image_format):
+            return accepted.get(comicstreamerlib.utils.image_formats[image_format][1], 0.0)
+
+        # WebP wins ties, as it encodes much faster than AVIF, and both win
+        # ties with JPEG, which is also what's left if neither is accepted
+        image_format = 'jpeg'
+        candidates = [f for f in ['webp', 'avif'] if f in formats and weight(f) > 0]
+        if len(candidates) > 0:
+            best = max(candidates, key=weight)
+            if weight(best) >= weight('jpeg'):
+                image_format = best
+        return image_format, quality, quality is not None
+
+    async def writeFileRange(self, path, offset, length, content_type):
+        # False if it can't be sent from the file, e.g. as the file has
+        # changed since the range was found
+        try:
+            view = await archive_pool.run(mapFileRange, path, offset, length)
+        except (OSError, ValueError) as e:
+            logging.error(u"writeFileRange(): [{0}] {1}".format(str(e), path))
+            return False
+        if view is None:
+            return False
+
+        self.setContentType(content_type)
+        self.set_header("Content-Length", length)
+        await self.flush()
+        await self.request.connection.write(view)
+        self.finish()
+        return True
 
 
 class VersionAPIHandler(JSONResultAPIHandler):
@@ -391,9 +614,9 @@ class VersionAPIHandler(JSONResultAPIHandler):
 
 
 class DBInfoAPIHandler(JSONResultAPIHandler):
-    def get(self):
+    async def get(self):
         self.validateAPIKey()
-        stats = self.library.getStats()
+        stats = await db_pool.run(self.library.getStats)
         response = {
             'id': stats['uuid'],
             'last_updated': stats['last_updated'].isoformat(),
@@ -407,9 +630,7 @@ class DBInfoAPIHandler(JSONResultAPIHandler):
 class ScanStatusAPIHandler(JSONResultAPIHandler):
     def get(self):
         self.validateAPIKey()
-        status = self.application.monitor.status
-        detail = self.application.monitor.statusdetail
-        last_complete = self.application.monitor.scancomplete_ts
+        (status, detail, last_complete) = self.application.getScanStatus()
 
         response = {
             'status': status,
@@ -423,7 +644,11 @@ class ScanStatusAPIHandler(JSONResultAPIHandler):
 
 
 class ComicListAPIHandler(ZippableAPIHandler):
-    def get(self):
+    def listComics(self, criteria, paging):
+        resultset, total_results = self.library.list(criteria, paging)
+        return resultSetToJson(resultset, "comics", total_results)
+
+    async def get(self):
         self.validateAPIKey()
 
         criteria_args = [
@@ -442,21 +667,20 @@ class ComicListAPIHandler(ZippableAPIHandler):
             'offset': self.get_argument(u"offset", default=None)
         }
 
-        resultset, total_results = self.library.list(criteria, paging)
-
-        json_data = resultSetToJson(resultset, "comics", total_results)
+        json_data = await db_pool.run(self.listComics, criteria, paging)
 
         self.writeResults(json_data)
 
 
 class DeletedAPIHandler(ZippableAPIHandler):
-    def get(self):
+    def listDeleted(self, since_filter):
+        return resultSetToJson(self.library.getDeletedComics(since_filter), "deletedcomics")
+
+    async def get(self):
         self.validateAPIKey()
 
         since_filter = self.get_argument(u"since", default=None)
-        resultset = self.library.getDeletedComics(since_filter)
-
-        json_data = resultSetToJson(resultset, "deletedcomics")
+        json_data = await db_pool.run(self.listDeleted, since_filter)
 
         self.writeResults(json_data)
 
@@ -514,21 +738,67 @@ class EntitiesBrowserHandler(BaseHandler):
             api_key=self.application.config['security']['api_key'])
 
 
+class CacheStatsAPIHandler(JSONResultAPIHandler):
+    def get(self):
+        self.validateAPIKey()
+        response = {'page_cache': page_cache.getStats()}
+        if self.application.render_cache is not None:
+            response['render_cache'] = self.application.render_cache.getStats()
+        response['compressed_cache'] = compressor.getStats()
+        self.setContentType()
+        self.write(response)
+
+
 class ComicAPIHandler(JSONResultAPIHandler):
-    def get(self, id):
+    keep_compressed = True
+
+    def getComicJson(self, id):
+        return resultSetToJson([self.library.getComic(id)], "comics")
+
+    async def get(self, id):
+        self.validateAPIKey()
+
+        json_data = await db_pool.run(self.getComicJson, id)
+
+        self.setContentType()
+        self.write(json_data)
+
+
+class ComicPagesAPIHandler(JSONResultAPIHandler):
+    keep_compressed = True
+
+    def getPagesJson(self, comic_id):
+        # sizes as found by the scanner, so a reader can lay out pages
+        # before fetching them
+        pages = [{
+            'page': page,
+            'image_type': image_type,
+            'size': size,
+            'width': width,
+            'height': height
+        } for (page, image_type, size, width, height) in self.library.getComicPages(comic_id)]
+        # for page urls that can be cached for good
+        version_info = self.library.getComicVersion(comic_id)
+        return json.dumps({
+            'pages': pages,
+            'page_count': len(pages),
+            'version': version_info[0] if version_info is not None else ""
+        })
+
+    async def get(self, comic_id):
         self.validateAPIKey()
 
-        result = [self.library.getComic(id)]
+        json_data = await db_pool.run(self.getPagesJson, comic_id)
 
         self.setContentType()
-        self.write(resultSetToJson(result, "comics"))
+        self.write(json_data)
 
 
 class ComicBookmarkAPIHandler(JSONResultAPIHandler):
-    def get(self, comic_id, pagenum):
+    async def get(self, comic_id, pagenum):
         self.validateAPIKey()
 
-        self.application.bookmarker.setBookmark(comic_id, pagenum)
+        await db_pool.run(self.application.bookmarker.setBookmark, comic_id, pagenum)
 
         self.setContentType()
         response = {'status': 0}
@@ -536,63 +806,346 @@ class ComicBookmarkAPIHandler(JSONResultAPIHandler):
 
 
 class ComicPageAPIHandler(ImageAPIHandler):
-    def get(self, comic_id, pagenum):
+    prefetch_args = None
+
+    def on_finish(self):
+        # read ahead once the page is out, if the client is going page by page
+        if self.prefetch_args is not None and self.get_status() == 200:
+            self.application.prefetcher.notePage(self.request.remote_ip, *self.prefetch_args)
+
+    async def get(self, comic_id, pagenum):
         self.validateAPIKey()
 
         max_height = self.get_argument(u"max_height", default=None)
+        if max_height is not None:
+            try:
+                max_height = int(max_height)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Bad max_height")
+        (image_format, quality, convert) = self.getOutputFormat()
+        mime_type = comicstreamerlib.utils.image_formats[image_format][1]
+        encode = max_height is not None or convert
+        self.prefetch_args = (comic_id, pagenum, max_height, image_format, quality, convert)
+
+        # a page only changes with the file, so the validators need no page data
+        version_info = await db_pool.run(self.library.getComicVersion, comic_id)
+        if version_info is not None:
+            (version, mod_ts) = version_info
+            etag = u"{0}-{1}-{2}".format(int(comic_id), version, int(pagenum))
+            if encode:
+                etag += u"-{0}{1}h{2}".format(image_format, quality or "", max_height or "")
+            if self.setCacheHeaders(etag, mod_ts, version):
+                return
+
+        # pages stored as is go out straight from the file
+        if not encode:
+            page_range = await archive_pool.run(self.library.getComicPageRange, comic_id, pagenum)
+            if page_range is not None:
+                (path, offset, length, image_type) = page_range
+                if await self.writeFileRange(path, offset, length, image_type or 'image/jpeg'):
+                    return
+
+        if encode:
+            image_data = await archive_pool.run(self.library.getRenderedPage, comic_id, pagenum, max_height,
+                                                image_format, quality)
+            if image_data is not None:
+                self.setContentType(mime_type)
+                self.write(image_data)
+                return
+
+        image_data, image_type = await archive_pool.run(self.library.getComicPageData, comic_id, pagenum)
+        if image_data is None:
+            self.clearCacheHeaders()
+            image_data, image_type = await archive_pool.run(self.library.getDefaultPage)
+        elif encode:
+            # resizing is left to the image workers, to keep the IOLoop free
+            try:
+                resized = await image_pool.resizePage(max_height, image_data, image_format, quality, convert)
+                if resized is not None:
+                    image_data, image_type = resized, mime_type
+                    await archive_pool.run(self.library.putRenderedPage, comic_id, pagenum, max_height,
+                                           image_format, quality, image_data)
+            except Exception as e:
+                logging.exception(e)
+                self.clearCacheHeaders()
 
-        image_data = self.library.getComicPage(comic_id, pagenum, max_height)
-
-        self.setContentType(image_data)
+        # the page table knows the type, so sniffing is only a fallback
+        self.setContentType(image_type or image_data)
         self.write(image_data)
 
 
-class ThumbnailAPIHandler(ImageAPIHandler):
-    def get(self, comic_id):
+class ComicPageDziAPIHandler(GenericAPIHandler):
+    async def get(self, comic_id, pagenum):
         self.validateAPIKey()
-        thumbnail = self.library.getComicThumbnail(comic_id)
+        # the size may have to come from the page itself
+        xml = await archive_pool.run(self.application.deepzoom.getDescriptor, comic_id, pagenum)
+        if xml is None:
+            raise tornado.web.HTTPError(404, "Unknown page")
+        self.set_header("Content-type", "application/xml; charset=UTF-8")
+        self.write(xml)
+
 
-        if thumbnail is not None:
-            self.setContentType('image/jpg')
-            self.write(thumbnail)
+class ComicPageTileAPIHandler(ImageAPIHandler):
+    async def get(self, comic_id, pagenum, level, col, row):
+        self.validateAPIKey()
+        tile = await self.application.deepzoom.getTile(comic_id, pagenum, int(level), int(col), int(row))
+        if tile is None:
+            raise tornado.web.HTTPError(404, "Unknown tile")
+        self.setContentType('image/jpeg')
+        self.write(tile)
+
+
+class ThumbnailAPIHandler(ImageAPIHandler):
+    def getThumbnailInfo(self, comic_id, size):
+        return self.library.getComicThumbnailKey(comic_id, size), self.library.getComicVersion(comic_id)
+
+    async def get(self, comic_id):
+        self.validateAPIKey()
+        size = self.get_argument(u"size", default=200)
+        try:
+            size = int(size)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Bad size")
+        (image_format, quality, convert) = self.getOutputFormat()
+        mime_type = comicstreamerlib.utils.image_formats[image_format][1]
+        (key, version_info) = await db_pool.run(self.getThumbnailInfo, comic_id, size)
+        stored = image_format == 'jpeg' and not convert
+
+        if key is not None:
+            # a stored thumbnail never changes, so its key makes a strong ETag
+            (version, mod_ts) = version_info or (None, None)
+            etag = key if stored else u"{0}-{1}{2}".format(key, image_format, quality or "")
+            if self.setCacheHeaders(etag, mod_ts, version):
+                return
+
+        if key is not None and stored:
+            path = self.library.thumbnail_store.pathFor(key)
+            if os.path.isfile(path) and await self.writeFileRange(path, 0, os.path.getsize(path), 'image/jpeg'):
+                return
+
+        thumbnail = None
+        if key is not None:
+            thumbnail = await archive_pool.run(self.library.thumbnail_store.get, key)
+
+        if thumbnail is None:
+            self.clearCacheHeaders()
+            thumbnail, image_type = await archive_pool.run(self.library.getDefaultPage)
         else:
-            default_img_file = AppFolders.imagePath("default.jpg")
-            with open(default_img_file, 'rb') as fd:
-                image_data = fd.read()
-            self.setContentType('image/jpg')
-            self.write(image_data)
+            # thumbnails are kept as JPEG, other variants are made on demand
+            image_type = 'image/jpeg'
+            if image_format != 'jpeg' or convert:
+                image_data = await archive_pool.run(self.library.getRenderedPage, comic_id, None, size,
+                                                    image_format, quality)
+                if image_data is None:
+                    try:
+                        image_data = await image_pool.resizePage(None, thumbnail, image_format, quality, True)
+                        if image_data is not None:
+                            await archive_pool.run(self.library.putRenderedPage, comic_id, None, size,
+                                                   image_format, quality, image_data)
+                    except Exception as e:
+                        logging.exception(e)
+                if image_data is not None:
+                    thumbnail, image_type = image_data, mime_type
+                else:
+                    self.clearCacheHeaders()
+
+        self.setContentType(image_type)
+        self.write(thumbnail)
+
+
+# most comics a sprite sheet may have
+MAX_SHEET_COMICS = 200
+
+
+def getThumbnailSheetArgs(handler):
+    try:
+        comic_ids = [int(i) for i in handler.get_argument(u"ids", default="").split(",") if i != ""]
+        size = int(handler.get_argument(u"size", default=200))
+    except ValueError:
+        raise tornado.web.HTTPError(400, "Bad ids or size")
+    if len(comic_ids) > MAX_SHEET_COMICS:
+        raise tornado.web.HTTPError(400, "Too many ids")
+    return comic_ids, size
+
+
+class ThumbnailSheetAPIHandler(JSONResultAPIHandler):
+    async def get(self):
+        self.validateAPIKey()
+        (comic_ids, size) = getThumbnailSheetArgs(self)
+        (sheet_key, tiles, (width, height)) = await db_pool.run(self.library.getThumbnailSheet, comic_ids, size)
+
+        # the key in the url changes with the sheet, so it can be cached for good
+        args = [('ids', u",".join(str(comic_id) for (comic_id, key, rect) in tiles)),
+                ('size', size),
+                ('v', sheet_key)]
+        api_key = self.get_argument(u"api_key", default=None)
+        if api_key is not None:
+            args.append(('api_key', api_key))
+
+        response = {
+            'sprite': self.webroot + u"/thumbnails/sprite?" + urllib.parse.urlencode(args, safe=","),
+            'width': width,
+            'height': height,
+            'tiles': [{
+                'id': comic_id,
+                'x': x,
+                'y': y,
+                'width': w,
+                'height': h
+            } for (comic_id, key, (x, y, w, h)) in tiles]
+        }
+        self.setContentType()
+        self.write(response)
+
+
+class ThumbnailSpriteAPIHandler(ImageAPIHandler):
+    def readThumbnails(self, keys):
+        return [self.library.thumbnail_store.get(key) for key in keys]
+
+    async def get(self):
+        self.validateAPIKey()
+        (comic_ids, size) = getThumbnailSheetArgs(self)
+        (sheet_key, tiles, sheet_size) = await db_pool.run(self.library.getThumbnailSheet, comic_ids, size)
+        if len(tiles) == 0:
+            raise tornado.web.HTTPError(404, "No thumbnails")
+
+        # the sheet's key is also the version the sheet's url carries
+        if self.setCacheHeaders(sheet_key, None, sheet_key):
+            return
+
+        render_cache = self.library.render_cache
+        sprite = None
+        if render_cache is not None:
+            sprite = await archive_pool.run(render_cache.get, sheet_key)
+        if sprite is None:
+            images = await archive_pool.run(self.readThumbnails, [key for (comic_id, key, rect) in tiles])
+            if None in images:
+                raise tornado.web.HTTPError(404, "Missing thumbnail")
+            sprite = await image_pool.makeSprite(images, [rect for (comic_id, key, rect) in tiles], sheet_size)
+            if render_cache is not None:
+                await archive_pool.run(render_cache.put, sheet_key, sprite)
+
+        self.setContentType('image/jpeg')
+        self.write(sprite)
+
+
+def parseByteRange(range_header, size):
+    """
+    (start, end) of the one byte range a Range header asks for, end
+    exclusive, or None if it isn't a range this can serve, in which case
+    the whole file is sent.  A range starting past the end comes back with
+    start == size.
+    """
+    if not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    (first, sep, last) = range_header[len("bytes="):].strip().partition("-")
+    if sep != "-":
+        return None
+    try:
+        if first == "":
+            # the last so many bytes
+            return max(size - int(last), 0) if int(last) > 0 else size, size
+        start = int(first)
+        end = int(last) + 1 if last != "" else size
+    except ValueError:
+        return None
+    if last != "" and end <= start:
+        return None
+    return min(start, size), min(end, size)
 
 
 class FileAPIHandler(GenericAPIHandler):
-    def get(self, comic_id):
+    # small, so a download takes about this much memory whatever the size
+    # of the file or the speed of the client
+    CHUNK_SIZE = 256 * 1024
+
+    def getFileInfo(self, comic_id):
+        return self.library.getComicPath(comic_id), self.library.getComicVersion(comic_id)
+
+    async def get(self, comic_id):
+        await self.sendFile(comic_id, True)
+
+    async def head(self, comic_id):
+        await self.sendFile(comic_id, False)
+
+    async def sendFile(self, comic_id, include_body):
         self.validateAPIKey()
 
-        obj = self.library.getComic(comic_id)
-        if obj is not None:
-            (content_type, encoding) = mimetypes.guess_type(obj.path)
-            if content_type is None:
-                content_type = "application/octet-stream"
-
-            self.add_header("Content-type", content_type)
-            self.add_header(
-                "Content-Disposition",
-                "attachment; filename=" + os.path.basename(obj.path))
-
-            # stream response in chunks, cbr/z could be over 300MB in size!
-            # TODO: check it doesn't buffer the response, it should send data chunk by chunk
-            with open(obj.path, 'rb') as f:
-                while True:
-                    data = f.read(40960 * 1024)
+        (path, version_info) = await db_pool.run(self.getFileInfo, comic_id)
+        if path is None:
+            raise tornado.web.HTTPError(404, "Unknown comic")
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise tornado.web.HTTPError(404, "Missing file")
+
+        validators = []
+        if version_info is not None:
+            (version, mod_ts) = version_info
+            etag = u"{0}-{1}".format(int(comic_id), version)
+            if self.setCacheHeaders(etag, mod_ts, version):
+                return
+            validators = [u'"{0}"'.format(etag), tornado.httputil.format_timestamp(mod_ts)]
+
+        self.set_header("Accept-Ranges", "bytes")
+
+        # a resumed download only gets the rest if the file is still the same
+        start, end = 0, size
+        range_header = self.request.headers.get("Range")
+        if_range = self.request.headers.get("If-Range")
+        if range_header is not None and (if_range is None or if_range in validators):
+            byte_range = parseByteRange(range_header, size)
+            if byte_range is not None:
+                (start, end) = byte_range
+                if start >= size:
+                    self.set_status(416)
+                    self.set_header("Content-Range", "bytes */{0}".format(size))
+                    return
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end - 1, size))
+
+        (content_type, encoding) = mimetypes.guess_type(path)
+        if content_type is None:
+            content_type = "application/octet-stream"
+
+        self.set_header("Content-type", content_type)
+        self.set_header(
+            "Content-Disposition",
+            "attachment; filename=" + os.path.basename(path))
+        self.set_header("Content-Length", end - start)
+        if not include_body:
+            return
+
+        # reads are done off the IOLoop, and each chunk is sent before the
+        # next is read
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    data = await archive_pool.run(f.read, min(self.CHUNK_SIZE, remaining))
                     if not data:
                         break
+                    remaining -= len(data)
                     self.write(data)
-                    self.flush()
-            self.finish()
+                    await self.flush()
+        except tornado.iostream.StreamClosedError:
+            # the client went away
+            return
 
 
 class FolderAPIHandler(JSONResultAPIHandler):
-    def get(self, args):
+    keep_compressed = True
+
+    async def get(self, args):
         self.validateAPIKey()
+        # the folder is listed along with the DB query, off the IOLoop
+        response = await db_pool.run(self.getFolder, args)
+
+        self.setContentType()
+        self.write(response)
+
+    def getFolder(self, args):
         if args is not None:
             args = urllib.parse.unquote(args)
             arglist = args.split('/')
@@ -657,13 +1210,20 @@ class FolderAPIHandler(JSONResultAPIHandler):
                 logging.error(e)
                 raise tornado.web.HTTPError(404, "Unknown folder")
 
-        self.setContentType()
-        self.write(response)
+        return response
 
 
 class EntityAPIHandler(JSONResultAPIHandler):
-    def get(self, args):
+    keep_compressed = True
+
+    async def get(self, args):
         self.validateAPIKey()
+        json_data = await db_pool.run(self.getEntities, args)
+
+        self.setContentType()
+        self.write(json_data)
+
+    def getEntities(self, args):
         session = self.application.dm.Session()
 
         if args is None:
@@ -732,9 +1292,7 @@ class EntityAPIHandler(JSONResultAPIHandler):
             # name_list = sorted(name_list)
 
             resp = {"entities": dict_list}
-            self.setContentType()
-            self.write(resp)
-            return
+            return json.dumps(resp)
 
         # odd number means listing last entity VALUES
         else:
@@ -760,11 +1318,10 @@ class EntityAPIHandler(JSONResultAPIHandler):
                     if i[0] is not None and i[0] not in _entities:
                         _entities.append(i[0])
 
-                resp = {entity: sorted(_entities)}
+                resp = json.dumps({entity: sorted(_entities)})
             self.application.dm.engine.echo = False
 
-        self.setContentType()
-        self.write(resp)
+        return resp
 
     def buildQuery(self, session, entities, arglist):
         """
@@ -834,30 +1391,37 @@ class EntityAPIHandler(JSONResultAPIHandler):
 
 
 class ReaderHandler(BaseHandler):
-    @tornado.web.authenticated
-    def get(self, comic_id):
-
+    def getReaderInfo(self, comic_id):
         obj = self.library.getComic(comic_id)
-        if obj is not None:
-            # self.render("templates/reader.html", make_list=self.make_list, id=comic_id, count=obj.page_count)
-            # self.render("test.html", make_list=self.make_list, id=comic_id, count=obj.page_count)
-
-            title = os.path.basename(obj.path)
-            if obj.series is not None and obj.issue is not None:
-                title = obj.series + u" #" + obj.issue
-                if obj.title is not None:
-                    title += u" -- " + obj.title
-            if obj.lastread_page is None:
-                target_page = 0
-            else:
-                target_page = obj.lastread_page
+        if obj is None:
+            return None
+        # self.render("templates/reader.html", make_list=self.make_list, id=comic_id, count=obj.page_count)
+        # self.render("test.html", make_list=self.make_list, id=comic_id, count=obj.page_count)
+
+        title = os.path.basename(obj.path)
+        if obj.series is not None and obj.issue is not None:
+            title = obj.series + u" #" + obj.issue
+            if obj.title is not None:
+                title += u" -- " + obj.title
+        if obj.lastread_page is None:
+            target_page = 0
+        else:
+            target_page = obj.lastread_page
+        return title, obj.page_count, target_page, obj.version or ""
 
+    @tornado.web.authenticated
+    async def get(self, comic_id):
+
+        info = await db_pool.run(self.getReaderInfo, comic_id)
+        if info is not None:
+            (title, page_count, target_page, version) = info
             self.render(
                 "cbreader.html",
                 title=title,
                 id=comic_id,
-                count=obj.page_count,
+                count=page_count,
                 page=target_page,
+                version=version,
                 api_key=self.application.config['security']['api_key'])
 
 
@@ -867,26 +1431,35 @@ class UnknownHandler(BaseHandler):
         self.write("Whoops! Four-oh-four.")
 
 
+# what the main page shows of a comic
+ComicSummary = collections.namedtuple('ComicSummary', ['id', 'series', 'issue', 'version'])
+
+
+def comicSummary(comic):
+    if comic is None:
+        return None
+    return ComicSummary(comic.id, comic.series, comic.issue, comic.version)
+
+
 class MainHandler(BaseHandler):
+    def getSummary(self):
+        return (self.library.getStats(),
+                [comicSummary(c) for c in self.library.recentlyAddedComics(10)],
+                [comicSummary(c) for c in self.library.recentlyReadComics(10)],
+                [role.name for role in self.library.getRoles()],
+                comicSummary(self.library.randomComic()))
+
     @tornado.web.authenticated
-    def get(self):
-        stats = self.library.getStats()
+    async def get(self):
+        (stats, recently_added_comics, recently_read_comics, roles_list,
+         random_comic) = await db_pool.run(self.getSummary)
         stats['last_updated'] = comicstreamerlib.utils.utc_to_local(
             stats['last_updated']).strftime("%Y-%m-%d %H:%M:%S")
         stats['created'] = comicstreamerlib.utils.utc_to_local(
             stats['created']).strftime("%Y-%m-%d %H:%M:%S")
 
-        recently_added_comics = self.library.recentlyAddedComics(10)
-        recently_read_comics = self.library.recentlyReadComics(10)
-        roles_list = [role.name for role in self.library.getRoles()]
-        random_comic = self.library.randomComic()
-
         if random_comic is None:
-            random_comic = type('fakecomic', (object,), {
-                'id': 0,
-                'series': 'No Comics',
-                'issue': 0
-            })()
+            random_comic = ComicSummary(0, 'No Comics', 0, "")
 
         self.render(
             "index.html",
@@ -988,7 +1561,7 @@ class ConfigPageHandler(BaseHandler):
         self.render_config(formdata)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         global new_port
         formdata = dict()
         formdata['port'] = self.get_argument(u"port", default="")
@@ -1083,7 +1656,7 @@ class ConfigPageHandler(BaseHandler):
             if formdata['use_authentication']:
                 if formdata['password'] == ConfigPageHandler.fakepass:
                     password_changed = False
-                elif comicstreamerlib.utils.getDigest(
+                elif await getDigest(
                         formdata['password']
                 ) == self.application.config['security']['password_digest']:
                     password_changed = False
@@ -1114,7 +1687,7 @@ class ConfigPageHandler(BaseHandler):
                     'username']
                 if formdata['password'] != ConfigPageHandler.fakepass:
                     self.application.config['security'][
-                        'password_digest'] = comicstreamerlib.utils.getDigest(
+                        'password_digest'] = await getDigest(
                         formdata['password'])
                 self.application.config['security']['use_api_key'] = formdata[
                     'use_api_key']
@@ -1138,7 +1711,7 @@ class ConfigPageHandler(BaseHandler):
 
 
 class LoginHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         if len(self.get_arguments("next")) != 0:
             next = self.get_argument("next")
         else:
@@ -1146,7 +1719,7 @@ class LoginHandler(BaseHandler):
 
         # if password and user are blank, just skip to the "next"
         if (self.application.config['security']['password_digest'] ==
-                comicstreamerlib.utils.getDigest("")
+                await getDigest("")
                 and self.application.config['security']['username'] == ""):
             self.set_secure_cookie(
                 "user",
@@ -1155,13 +1728,13 @@ class LoginHandler(BaseHandler):
         else:
             self.render('login.html', next=next)
 
-    def post(self):
+    async def post(self):
         next = self.get_argument("next")
 
         if len(self.get_arguments("password")) != 0:
 
             # print self.application.password, self.get_argument("password") , next
-            if (comicstreamerlib.utils.getDigest(
+            if (await getDigest(
                     self.get_argument("password")) ==
                     self.application.config['security']['password_digest']
                     and self.get_argument("username") ==
@@ -1187,12 +1760,48 @@ class APIServer(tornado.web.Application):
 
         self.comicArchiveList = []
 
+        # serving processes; with more than one, the budgets of the caches
+        # each process keeps are shared out between them
+        self.processes = processCount(self.config['performance']['processes'])
+        self.task_id = None
+        self.parent_pid = None
+        self.monitor = None
+        self.transcoder = None
+
         # if len(self.config['general']['folder_list']) == 0:
         #    logging.error("No folders on either command-line or config file.  Quitting.")
         #    sys.exit(-1)
 
+        zip_pool.setMaxOpen(self.config['performance']['max_open_archives'])
+        page_cache.setMaxBytes(self.config['performance']['page_cache_mb'] * 1024 * 1024 // self.processes)
+        RarArchiver.decode_solid_once = self.config['performance']['solid_rar_decode_once']
+        pdf_render_pool.setWorkers(self.config['performance']['pdf_render_workers'])
+        image_workers = self.config['performance']['image_workers']
+        if image_workers == 0 and self.processes > 1:
+            image_workers = max((os.cpu_count() or 1) // self.processes, 1)
+        image_pool.setWorkers(image_workers)
+        image_pool.setLimits(self.config['performance']['max_image_megapixels'] * 1000 * 1000,
+                             self.config['performance']['decode_budget_megapixels'] * 1000 * 1000,
+                             self.config['performance']['large_decodes'])
+        db_pool.setWorkers(self.config['performance']['db_threads'])
+        archive_pool.setWorkers(self.config['performance']['archive_threads'])
+        compressor.setLevels(self.config['performance']['gzip_level'], self.config['performance']['brotli_quality'])
+        compressor.setMaxBytes(self.config['performance']['compressed_cache_mb'] * 1024 * 1024 // self.processes)
+
         self.dm = DataManager()
-        self.library = Library(self.dm.Session)
+        # each job leaves its thread without a session
+        db_pool.setCleanup(self.dm.Session.remove)
+        archive_pool.setCleanup(self.dm.Session.remove)
+
+        # resized pages are kept on disk, unless the budget is zero
+        self.render_cache = None
+        if self.config['performance']['render_cache_mb'] > 0:
+            self.render_cache = RenderCache(os.path.join(AppFolders.appData(), "cache", "render"),
+                                            self.config['performance']['render_cache_mb'] * 1024 * 1024,
+                                            shared=self.processes > 1)
+        self.library = Library(self.dm.Session, self.render_cache, self.dm.thumbnail_store)
+        self.deepzoom = DeepZoom(self.library)
+        self.prefetcher = Prefetcher(self.library, self.config['performance']['prefetch_pages'])
 
         if opts.reset or opts.reset_and_run:
             logging.info("Deleting any existing database!")
@@ -1211,7 +1820,7 @@ class APIServer(tornado.web.Application):
             sys.exit(-1)
 
         try:
-            self.listen(self.port, no_keep_alive=True)
+            sockets = bindPort(self.port)
         except Exception as e:
             logging.error(e)
             msg = "Couldn't open socket on port {0}. (Maybe ComicStreamer is already running?) Quitting.".format(
@@ -1220,6 +1829,24 @@ class APIServer(tornado.web.Application):
             comicstreamerlib.utils.alert("Port not available", msg)
             sys.exit(-1)
 
+        # made before the fork, to be shared by all the processes
+        self.scan_state = None
+        bookmark_queue = None
+        if self.processes > 1:
+            self.scan_state = SharedState()
+            bookmark_queue = multiprocessing.Queue()
+            # no DB connection may be carried over into the processes
+            self.dm.Session.remove()
+            self.dm.engine.dispose()
+            self.parent_pid = os.getpid()
+            logging.info("Forking {0} server processes...".format(self.processes))
+            self.task_id = forkServers(self.processes)
+            if self.render_cache is not None:
+                self.render_cache.takeShare(self.task_id, self.processes)
+
+        self.http_server = tornado.httpserver.HTTPServer(self)
+        self.http_server.add_sockets(sockets)
+
         logging.info("Stream server running on port {0}...".format(self.port))
 
         # http_server = tornado.httpserver.HTTPServer(self, no_keep_alive = True, ssl_options={
@@ -1249,9 +1876,16 @@ class APIServer(tornado.web.Application):
             (self.webroot + r"/deleted", DeletedAPIHandler),
             (self.webroot + r"/comic/([0-9]+)", ComicAPIHandler),
             (self.webroot + r"/comiclist", ComicListAPIHandler),
+            (self.webroot + r"/cachestats", CacheStatsAPIHandler),
             (self.webroot + r"/comic/([0-9]+)/page/([0-9]+|clear)/bookmark", ComicBookmarkAPIHandler),
             (self.webroot + r"/comic/([0-9]+)/page/([0-9]+)", ComicPageAPIHandler),
+            (self.webroot + r"/comic/([0-9]+)/page/([0-9]+)\.dzi", ComicPageDziAPIHandler),
+            (self.webroot + r"/comic/([0-9]+)/page/([0-9]+)_files/([0-9]+)/([0-9]+)_([0-9]+)\.jpg",
+             ComicPageTileAPIHandler),
+            (self.webroot + r"/comic/([0-9]+)/pages", ComicPagesAPIHandler),
             (self.webroot + r"/comic/([0-9]+)/thumbnail", ThumbnailAPIHandler),
+            (self.webroot + r"/thumbnails", ThumbnailSheetAPIHandler),
+            (self.webroot + r"/thumbnails/sprite", ThumbnailSpriteAPIHandler),
             (self.webroot + r"/comic/([0-9]+)/file", FileAPIHandler),
             (self.webroot + r"/entities(/.*)*", EntityAPIHandler),
             (self.webroot + r"/folders(/.*)*", FolderAPIHandler),
@@ -1274,7 +1908,8 @@ class APIServer(tornado.web.Application):
 
         tornado.web.Application.__init__(self, handlers, **settings)
 
-        if not opts.no_monitor:
+        # the scanner and the bookmarker run in just one of the processes
+        if not opts.no_monitor and self.isMainProcess():
             logging.debug("Going to scan the following folders:")
             for l in self.config['general']['folder_list']:
                 logging.debug(u"   {0}".format(repr(l)))
@@ -1284,10 +1919,21 @@ class APIServer(tornado.web.Application):
             self.monitor.start()
             self.monitor.scan()
 
-        self.bookmarker = Bookmarker(self.dm)
-        self.bookmarker.start()
+        if self.monitor is not None and self.config['performance']['transcode_rar']:
+            self.transcoder = Transcoder(self.dm, self.monitor,
+                                         pause=self.config['performance']['transcode_pause'])
+            self.transcoder.start()
+
+        self.bookmarker = Bookmarker(self.dm, bookmark_queue)
+        if self.isMainProcess():
+            self.bookmarker.start()
+
+        if self.task_id is not None:
+            if self.monitor is not None:
+                tornado.ioloop.PeriodicCallback(self.publishScanStatus, 1000).start()
+            tornado.ioloop.PeriodicCallback(self.checkParent, 1000).start()
 
-        if opts.launch_browser and self.config['general']['launch_browser']:
+        if opts.launch_browser and self.config['general']['launch_browser'] and self.isMainProcess():
             if ((platform.system() == "Linux" and ('DISPLAY' in os.environ))
                     or (platform.system() == "Darwin"
                         and not ('SSH_TTY' in os.environ))
@@ -1295,6 +1941,28 @@ class APIServer(tornado.web.Application):
                 webbrowser.open(
                     "http://localhost:{0}".format(self.port), new=0)
 
+    def isMainProcess(self):
+        return self.task_id is None or self.task_id == 0
+
+    def getScanStatus(self):
+        """(status, detail, last_complete) of the scanner, wherever it runs"""
+        if self.monitor is not None:
+            return self.monitor.status, self.monitor.statusdetail, self.monitor.scancomplete_ts
+        if self.scan_state is not None:
+            return tuple(self.scan_state.get(["IDLE", "", ""]))
+        return "IDLE", "", ""
+
+    def publishScanStatus(self):
+        (status, detail, last_complete) = self.getScanStatus()
+        self.scan_state.set([status, detail[:1024], last_complete])
+
+    def checkParent(self):
+        # a process left behind by its parent takes itself down
+        if self.parent_pid is not None and os.getppid() != self.parent_pid:
+            logging.info("Server process {0} lost its parent".format(self.task_id))
+            self.parent_pid = None
+            self.shutdown()
+
     def rebuild(self):
         # after restart, purge the DB
         sys.argv.insert(1, "--_resetdb_and_run")
@@ -1325,8 +1993,22 @@ class APIServer(tornado.web.Application):
         MAX_WAIT_SECONDS_BEFORE_SHUTDOWN = 3
 
         logging.info('Initiating shutdown...')
-        self.monitor.stop()
+        # let go of the port now, for a server that is restarting
+        self.http_server.stop()
+        if self.parent_pid is not None and os.getppid() == self.parent_pid:
+            # the parent would just fork a new process, so take it down
+            # instead; the other processes follow once they notice
+            os.kill(self.parent_pid, signal.SIGTERM)
+            self.parent_pid = None
+        if self.transcoder is not None:
+            self.transcoder.stop()
+        if self.monitor is not None:
+            self.monitor.stop()
         self.bookmarker.stop()
+        pdf_render_pool.stop()
+        image_pool.stop()
+        db_pool.stop()
+        archive_pool.stop()
 
         logging.info('Will shutdown ComicStreamer in maximum %s seconds ...',
                      MAX_WAIT_SECONDS_BEFORE_SHUTDOWN)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer background CBR to CBZ transcoder thread
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from comicapi.comicarchive import ComicArchive
+from comicstreamerlib.database import Comic
+from comicstreamerlib.folders import AppFolders
+from comicstreamerlib.library import Library
+
+
+class Transcoder(threading.Thread):
+    """
+    Converts the RAR comics in the library to CBZ, one at a time.  Pages
+    in a zip can be read on their own, or even sent straight from the file,
+    where a RAR may need everything before them decompressed first.
+
+    The new file is written next to the old one under a hidden name and
+    only swapped in once complete, and the comic's row is updated in
+    place, so its id and bookmark stay the same.
+    """
+
+    def __init__(self, dm, monitor, pause=0.05, idle_wait=300):
+        super(Transcoder, self).__init__()
+        self.daemon = True
+
+        self.dm = dm
+        self.monitor = monitor
+        self.pause = pause
+        self.idle_wait = idle_wait
+        self.quit = False
+        self.failed = set()
+
+    def stop(self):
+        self.quit = True
+        self.join()
+
+    def run(self):
+        logging.debug("Transcoder: started main loop.")
+        self.library = Library(self.dm.Session)
+        while not self.quit:
+            try:
+                done = self.transcodeNext()
+            except Exception as e:
+                logging.exception(e)
+                done = False
+
+            if not done:
+                # nothing left for now, check back later
+                for i in range(self.idle_wait):
+                    if self.quit:
+                        break
+                    time.sleep(1)
+
+        self.dm.Session.remove()
+        logging.debug("Transcoder: stopped main loop.")
+
+    def transcodeNext(self):
+        session = self.dm.Session()
+        query = session.query(Comic.id, Comic.path) \
+            .filter(Comic.path.ilike(u"%.cbr"))
+        if len(self.failed) > 0:
+            query = query.filter(~Comic.id.in_(self.failed))
+        row = query.first()
+        session.commit()
+        if row is None:
+            return False
+
+        (comic_id, path) = row
+        if not self.transcode(comic_id, path):
+            self.failed.add(comic_id)
+        return True
+
+    def transcode(self, comic_id, path):
+        new_path = os.path.splitext(path)[0] + ".cbz"
+        if os.path.exists(new_path):
+            logging.info(u"Transcoder: {0} already exists, leaving {1} as is".format(new_path, path))
+            return False
+
+        ca = ComicArchive(path, default_image_path=AppFolders.imagePath("default.jpg"))
+        if not ca.isRar():
+            return False
+        mod_ts = datetime.utcfromtimestamp(os.path.getmtime(path))
+
+        logging.info(u"Transcoder: converting {0}".format(path))
+        # hidden, so a scan passes it by, but named as a CBZ to be probed as one
+        tmp_fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp.cbz")
+        os.close(tmp_fd)
+        try:
+            # a stop gives up on the conversion between members, and the
+            # partial file goes with the temp file
+            if not ca.exportAsZip(tmp_name, pause=self.pause, cancelled=lambda: self.quit):
+                return False
+
+            # make sure nothing went missing on the way
+            new_ca = ComicArchive(tmp_name, default_image_path=AppFolders.imagePath("default.jpg"))
+            probe = new_ca.probe()
+            if not new_ca.isZip() or len(probe.page_list) != ca.getNumberOfPages():
+                logging.error(u"Transcoder: page count mismatch converting {0}".format(path))
+                return False
+
+            # the temp file was made private; the comic keeps the RAR's
+            # permissions, and its owner where we may set that
+            shutil.copymode(path, tmp_name)
+            if hasattr(os, 'chown'):
+                statinfo = os.stat(path)
+                try:
+                    os.chown(tmp_name, statinfo.st_uid, statinfo.st_gid)
+                except OSError:
+                    pass
+
+            # keep the monitor from scanning while the files and the
+            # database disagree
+            with self.monitor.scan_lock:
+                if self.quit or datetime.utcfromtimestamp(os.path.getmtime(path)) != mod_ts:
+                    return False
+                os.replace(tmp_name, new_path)
+                try:
+                    self.library.moveComic(comic_id, new_path, probe.pages)
+                except Exception:
+                    os.replace(new_path, tmp_name)
+                    raise
+                os.remove(path)
+            logging.info(u"Transcoder: {0} is now {1}".format(path, new_path))
+            return True
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
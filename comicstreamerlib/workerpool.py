@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# Do not change the previous lines. See PEP 8, PEP 263.
+#
+"""
+ComicStreamer pools of threads for blocking work done for requests
+
+Copyright 2012-2014  Anthony Beville
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+	http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import concurrent.futures
+import threading
+
+import tornado.ioloop
+
+
+class WorkerPool:
+    """
+    A fixed number of threads for one kind of blocking work, so that
+    handlers can await it instead of holding up the IOLoop, and so that a
+    flood of one kind (say, archive reads) can't take all the threads
+    another kind (say, DB queries) needs.
+
+    cleanup, if set, is called in the thread after every job, e.g. to drop
+    the thread's DB session, so nothing a job loaded outlives it.  Results
+    must therefore be plain data, not ORM objects, whose relationships
+    can't be loaded any more once their session is gone.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.cleanup = None
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def setWorkers(self, workers):
+        with self.lock:
+            self.workers = workers
+            self.shutdownExecutor(wait=False)
+
+    def setCleanup(self, cleanup):
+        self.cleanup = cleanup
+
+    def getExecutor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                      thread_name_prefix=self.name)
+            return self.executor
+
+    def stop(self):
+        with self.lock:
+            self.shutdownExecutor()
+
+    # must be called with self.lock held
+    def shutdownExecutor(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def runJob(self, func, args):
+        try:
+            return func(*args)
+        finally:
+            if self.cleanup is not None:
+                self.cleanup()
+
+    async def run(self, func, *args):
+        """Awaitable result of func(*args), from one of the threads"""
+        return await tornado.ioloop.IOLoop.current().run_in_executor(self.getExecutor(), self.runJob, func,
+                                                                     args)
+
+
+# DB queries, and building the JSON of what they return
+db_pool = WorkerPool("db", 4)
+# reads of pages from archives, and of other files
+archive_pool = WorkerPool("archive", 8)